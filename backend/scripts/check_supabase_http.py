@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Check `SupabaseRestClient` against a local `http.server` stub.
+
+不需要 Supabase 账号，也不依赖第三方包：
+
+    python3 backend/scripts/check_supabase_http.py
+
+覆盖连接复用（包括服务端关掉 keep-alive 连接后自动换连接重试）、gzip 响应解压、
+gzip 请求体，以及非 2xx 响应抛出 `SupabaseHTTPError`。
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from supabase_http import SupabaseHTTPError, SupabaseRestClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """按路径返回不同响应，并记录每个请求来自哪个客户端端口（即哪条 TCP 连接）。"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _reply(self, status: int, payload: object, compress: bool = False) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if compress:
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self.server.requests.append((self.path, self.client_address[1], self.headers.get("Accept-Encoding")))
+        if self.path == "/rest/v1/drop":
+            self._reply(200, {"ok": True})
+            # 不发 `Connection: close` 就断开，模拟空闲连接被服务端按 keep-alive 超时关闭。
+            self.close_connection = True
+        elif self.path == "/rest/v1/gzip":
+            self._reply(200, [{"id": 1, "content": "压缩" * 200}], compress=True)
+        elif self.path == "/rest/v1/missing":
+            self._reply(404, {"code": "PGRST205", "message": "Could not find the table"})
+        else:
+            self._reply(200, {"ok": True})
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.requests.append((self.path, self.client_address[1], self.headers.get("Content-Encoding")))
+        self._reply(201, json.loads(body))
+
+
+class SupabaseRestClientCheck(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = SupabaseRestClient(f"http://127.0.0.1:{self.server.server_port}", "test-key", pool_size=1)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def ports(self) -> list[int]:
+        return [port for _, port, _ in self.server.requests]
+
+    def test_keep_alive_reuses_connection(self) -> None:
+        for _ in range(3):
+            self.assertEqual(self.client.request_json("GET", "/rest/v1/ok")[0], {"ok": True})
+        self.assertEqual(len(set(self.ports())), 1)
+
+    def test_reconnects_after_server_closes_idle_connection(self) -> None:
+        self.client.request_json("GET", "/rest/v1/drop")
+        self.assertEqual(self.client.request_json("GET", "/rest/v1/ok")[0], {"ok": True})
+        self.assertEqual([path for path, _, _ in self.server.requests], ["/rest/v1/drop", "/rest/v1/ok"])
+        self.assertNotEqual(self.ports()[0], self.ports()[1])
+
+    def test_gzip_response_is_decoded(self) -> None:
+        payload, headers = self.client.request_json("GET", "/rest/v1/gzip")
+        self.assertEqual(payload, [{"id": 1, "content": "压缩" * 200}])
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(self.server.requests[0][2], "gzip")
+
+    def test_gzip_request_body(self) -> None:
+        client = SupabaseRestClient(
+            f"http://127.0.0.1:{self.server.server_port}",
+            "test-key",
+            gzip_requests=True,
+        )
+        rows = [{"content": "x" * 2000}]
+        try:
+            self.assertEqual(client.request_json("POST", "/rest/v1/rows", body=rows)[0], rows)
+        finally:
+            client.close()
+        self.assertEqual(self.server.requests[0][2], "gzip")
+
+    def test_non_2xx_raises_http_error(self) -> None:
+        with self.assertRaises(SupabaseHTTPError) as caught:
+            self.client.request_json("GET", "/rest/v1/missing")
+        self.assertEqual(caught.exception.status, 404)
+        self.assertIn("PGRST205", caught.exception.body)
+        # 错误响应也读完了响应体，连接仍可复用。
+        self.client.request_json("GET", "/rest/v1/ok")
+        self.assertEqual(len(set(self.ports())), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Columnar on-disk export of ingest embeddings.
+
+入库时除了写 Supabase，还可以把向量顺手落成一个紧凑的本地产物，之后重建索引、
+灌进新库或者跑离线评测都不用再跑一遍 4B 模型：
+
+- `vectors.npy`：`rows x dim` 的向量矩阵，`float32` / `float16` / `int8` 三选一，
+  可以直接 `numpy.load(..., mmap_mode="r")` 零拷贝打开
+- `scales.npy`：仅 `int8` 时存在，每行一个 `float32` 缩放系数，`vector ≈ int8 * scale`
+- `ids.jsonl`：与矩阵逐行对应的 `external_id` / `content_hash` 等元数据
+- `manifest.json`：维度、精度、行数、模型和数据版本等说明
+
+写入端直接按 `.npy` v1.0 格式写文件，头部预留固定长度，收尾时原地回填行数。
+"""
+
+from __future__ import annotations
+
+import ast
+import json
+import os
+import struct
+from array import array
+from pathlib import Path
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# 预留的 `.npy` 头部总长度（含 magic），必须是 64 的倍数。
+NPY_HEADER_BYTES = 128
+EXPORT_DTYPES = {"float32": "<f4", "float16": "<f2", "int8": "|i1"}
+
+
+def npy_header(descr: str, shape: tuple[int, ...]) -> bytes:
+    """生成固定长度的 `.npy` v1.0 头部，方便写完数据后原地改写 shape。"""
+    header = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': {shape!r}, }}"
+    body_length = NPY_HEADER_BYTES - len(NPY_MAGIC) - 2
+    header = header.ljust(body_length - 1) + "\n"
+    return NPY_MAGIC + struct.pack("<H", body_length) + header.encode("latin1")
+
+
+def read_npy_header(handle) -> tuple[str, tuple[int, ...], int]:
+    """读取 `.npy` v1.0 头部，返回 `(descr, shape, 数据起始偏移)`。"""
+    if handle.read(len(NPY_MAGIC)) != NPY_MAGIC:
+        raise ValueError("Not a .npy v1.0 file")
+    (length,) = struct.unpack("<H", handle.read(2))
+    meta = ast.literal_eval(handle.read(length).decode("latin1"))
+    return meta["descr"], tuple(meta["shape"]), len(NPY_MAGIC) + 2 + length
+
+
+def quantize_int8(vector: list[float]) -> tuple[bytes, float]:
+    """按行对称量化：`scale = max(|x|) / 127`。"""
+    peak = max((abs(value) for value in vector), default=0.0)
+    scale = peak / 127.0 if peak > 0 else 1.0
+    quantized = array("b", (max(-127, min(127, round(value / scale))) for value in vector))
+    return quantized.tobytes(), scale
+
+
+class EmbeddingArtifactWriter:
+    """按批追加向量，`close()` 时回填行数并写 manifest。
+
+    `ids.jsonl` 每行带上该批在 JSONL 里的结束偏移；断点续跑时按 checkpoint 偏移截掉
+    上次中断后多写的尾部行，保证产物与 checkpoint 一致、不会出现重复行。
+    调用方要在每次推进 checkpoint 之前 `flush()`，续跑时产物才不会比 checkpoint 少行；
+    万一还是少了（`committed_rows` 对不上），直接报错，不会从头覆盖已有产物。
+    """
+
+    def __init__(
+        self,
+        export_dir: str,
+        dim: int,
+        dtype: str,
+        resume_offset: int,
+        manifest: dict,
+        committed_rows: int = 0,
+    ) -> None:
+        if dtype not in EXPORT_DTYPES:
+            raise ValueError(f"Unsupported export dtype: {dtype}")
+        self.dir = Path(export_dir)
+        self.dim = dim
+        self.dtype = dtype
+        self.manifest = manifest
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.dir / "vectors.npy"
+        self.scales_path = self.dir / "scales.npy"
+        self.ids_path = self.dir / "ids.jsonl"
+        self.row_bytes = dim * int(EXPORT_DTYPES[dtype][2:])
+
+        self.rows = self._resume_rows(resume_offset, committed_rows) if resume_offset > 0 else 0
+        self._vectors = self._open_matrix(self.vectors_path, EXPORT_DTYPES[dtype], (self.dim,))
+        self._scales = self._open_matrix(self.scales_path, "<f4", ()) if dtype == "int8" else None
+        self._ids = self.ids_path.open("a" if self.rows else "w", encoding="utf-8")
+
+    def _resume_rows(self, resume_offset: int, committed_rows: int) -> int:
+        """统计偏移不超过 `resume_offset` 且向量完整落盘的行数，并截掉其后的行。
+
+        少于 checkpoint 已提交的 `committed_rows` 时说明产物丢了行（比如上次的写入没落盘），
+        这时续写只会得到缺头的矩阵，所以报错而不是接着写。
+        """
+        if not self.ids_path.exists() or not self.vectors_path.exists():
+            raise RuntimeError(
+                f"Cannot resume export in {self.dir}: previous artifact files are missing; "
+                "rerun with --reset-checkpoint."
+            )
+        kept: list[str] = []
+        with self.ids_path.open("r", encoding="utf-8") as handle:
+            for line in handle:
+                try:
+                    offset = json.loads(line)["offset"]
+                except json.JSONDecodeError:
+                    # 中断时最后一行可能只写了一半。
+                    break
+                if offset > resume_offset:
+                    break
+                kept.append(line)
+        available = (self.vectors_path.stat().st_size - NPY_HEADER_BYTES) // self.row_bytes
+        if self.dtype == "int8" and self.scales_path.exists():
+            available = min(available, (self.scales_path.stat().st_size - NPY_HEADER_BYTES) // 4)
+        kept = kept[: max(0, available)]
+        if len(kept) < committed_rows:
+            raise RuntimeError(
+                f"Cannot resume export in {self.dir}: it holds {len(kept)} rows but the checkpoint "
+                f"already committed {committed_rows}; rerun with --reset-checkpoint."
+            )
+        self.ids_path.write_text("".join(kept), encoding="utf-8")
+        return len(kept)
+
+    def _open_matrix(self, path: Path, descr: str, row_shape: tuple[int, ...]):
+        row_bytes = int(descr[2:]) * (row_shape[0] if row_shape else 1)
+        if self.rows:
+            handle = path.open("r+b")
+            handle.truncate(NPY_HEADER_BYTES + self.rows * row_bytes)
+            handle.seek(0, 2)
+            return handle
+        handle = path.open("wb")
+        handle.write(npy_header(descr, (0, *row_shape)))
+        return handle
+
+    def append(self, rows: list[dict], end_offset: int) -> None:
+        """追加一批 `build_rows` 产出的行（需要带 `embedding`）。"""
+        for row in rows:
+            vector = row["embedding"]
+            if self.dtype == "float32":
+                self._vectors.write(array("f", vector).tobytes())
+            elif self.dtype == "float16":
+                self._vectors.write(struct.pack(f"<{len(vector)}e", *vector))
+            else:
+                data, scale = quantize_int8(vector)
+                self._vectors.write(data)
+                self._scales.write(struct.pack("<f", scale))
+            self._ids.write(
+                json.dumps(
+                    {
+                        "external_id": row.get("external_id"),
+                        "content_hash": row.get("content_hash"),
+                        "offset": end_offset,
+                    },
+                    ensure_ascii=False,
+                )
+            )
+            self._ids.write("\n")
+        self.rows += len(rows)
+
+    def _matrices(self) -> list[tuple]:
+        matrices = [(self._vectors, EXPORT_DTYPES[self.dtype], (self.rows, self.dim))]
+        if self._scales is not None:
+            matrices.append((self._scales, "<f4", (self.rows,)))
+        return matrices
+
+    def flush(self) -> None:
+        """回填当前行数并 fsync 所有文件；之后再推进 checkpoint，断电也不会让产物落后。"""
+        for handle, descr, shape in self._matrices():
+            handle.seek(0)
+            handle.write(npy_header(descr, shape))
+            handle.seek(0, 2)
+        for handle in [self._ids, *(handle for handle, _, _ in self._matrices())]:
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    def close(self) -> None:
+        """回填行数、关闭文件并写 manifest；失败路径上也要调用，重复调用无副作用。"""
+        if self._ids.closed:
+            return
+        for handle, descr, shape in self._matrices():
+            handle.seek(0)
+            handle.write(npy_header(descr, shape))
+            handle.close()
+        self._ids.close()
+        manifest = dict(self.manifest)
+        manifest.update({"rows": self.rows, "dim": self.dim, "dtype": self.dtype})
+        with (self.dir / "manifest.json").open("w", encoding="utf-8") as handle:
+            json.dump(manifest, handle, ensure_ascii=False, indent=2)
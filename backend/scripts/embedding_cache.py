@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Persistent on-disk vector cache shared by the local Qwen scripts.
+
+向量按 `(namespace, key)` 存在一个 SQLite 文件里：
+- `namespace` 区分模型、模型版本和输出维度，换模型或换维度不会串用旧向量
+- `key` 通常是文本的 MD5（入库时就是 `content_hash`）
+
+缓存有容量上限，超出后按最近使用时间淘汰最旧的条目。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import time
+from array import array
+from pathlib import Path
+from typing import Callable, Iterable, Sequence
+
+# SQLite 单条语句的参数个数有上限，批量查询时按这个大小分段。
+SQLITE_BATCH = 500
+
+
+def model_fingerprint(model_path: str) -> str:
+    """为本地模型目录生成稳定标识：解析后的路径 + 配置文件内容摘要。
+
+    同一路径下替换了模型（例如换了 revision），配置文件摘要通常也会变，
+    从而让旧缓存自然失效。
+    """
+    path = Path(model_path).resolve()
+    parts = [str(path)]
+    for name in ("config.json", "model.safetensors.index.json"):
+        candidate = path / name
+        if candidate.exists():
+            parts.append(f"{name}:{hashlib.md5(candidate.read_bytes()).hexdigest()}")
+    return "|".join(parts)
+
+
+class EmbeddingCache:
+    """SQLite 持久化向量缓存，带按字节数的 LRU 淘汰。"""
+
+    def __init__(self, db_path: str, namespace: str, max_bytes: int) -> None:
+        self.db_path = Path(db_path)
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS vectors (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_vectors_last_used ON vectors(last_used)")
+        self.conn.commit()
+        row = self.conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM vectors").fetchone()
+        self.total_bytes = int(row[0])
+        self.total_rows = int(row[1])
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Sequence[float]]:
+        """批量查询；命中的条目会刷新最近使用时间。"""
+        unique_keys = list(dict.fromkeys(keys))
+        found: dict[str, Sequence[float]] = {}
+        for start in range(0, len(unique_keys), SQLITE_BATCH):
+            part = unique_keys[start:start + SQLITE_BATCH]
+            placeholders = ",".join("?" for _ in part)
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM vectors WHERE namespace = ? AND key IN ({placeholders})",
+                [self.namespace, *part],
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob)
+        if found:
+            now = int(time.time())
+            self.conn.executemany(
+                "UPDATE vectors SET last_used = ? WHERE namespace = ? AND key = ?",
+                [(now, self.namespace, key) for key in found],
+            )
+            self.conn.commit()
+        return found
+
+    def put_many(self, items: dict[str, Sequence[float]]) -> None:
+        """批量写入；写完后如果超过容量上限就淘汰最久未使用的条目。"""
+        if not items:
+            return
+        now = int(time.time())
+        payload = [(self.namespace, key, array("f", vector).tobytes(), now) for key, vector in items.items()]
+        existing = self._stored_sizes(items.keys())
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO vectors (namespace, key, vector, last_used) VALUES (?, ?, ?, ?)",
+            payload,
+        )
+        self.conn.commit()
+        for _, key, blob, _ in payload:
+            self.total_bytes += len(blob) - existing.get(key, 0)
+            self.total_rows += 0 if key in existing else 1
+        if self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def _stored_sizes(self, keys: Iterable[str]) -> dict[str, int]:
+        sizes: dict[str, int] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), SQLITE_BATCH):
+            part = unique_keys[start:start + SQLITE_BATCH]
+            placeholders = ",".join("?" for _ in part)
+            rows = self.conn.execute(
+                f"SELECT key, LENGTH(vector) FROM vectors WHERE namespace = ? AND key IN ({placeholders})",
+                [self.namespace, *part],
+            ).fetchall()
+            sizes.update({key: int(size) for key, size in rows})
+        return sizes
+
+    def evict(self) -> None:
+        """淘汰最久未使用的条目，直到总大小回落到上限的 90%。
+
+        一次多删一点，避免每写一批都触发一次淘汰。
+        """
+        target = int(self.max_bytes * 0.9)
+        while self.total_bytes > target and self.total_rows > 0:
+            average = max(1, self.total_bytes // self.total_rows)
+            limit = max(1, (self.total_bytes - target) // average + 1)
+            rows = self.conn.execute(
+                "SELECT namespace, key, LENGTH(vector) FROM vectors ORDER BY last_used ASC LIMIT ?",
+                (limit,),
+            ).fetchall()
+            if not rows:
+                break
+            self.conn.executemany(
+                "DELETE FROM vectors WHERE namespace = ? AND key = ?",
+                [(namespace, key) for namespace, key, _ in rows],
+            )
+            self.total_bytes -= sum(int(size) for _, _, size in rows)
+            self.total_rows -= len(rows)
+        self.conn.commit()
+
+
+class PendingEmbedding:
+    """延迟取结果的句柄，接口与 `Future.result()` 一致。
+
+    `result()` 在调用方线程里执行，所以写缓存（SQLite 连接）始终发生在主线程。
+    """
+
+    def __init__(self, finish: Callable[[], list[Sequence[float]]]) -> None:
+        self._finish = finish
+        self._done = False
+        self._value: list[Sequence[float]] = []
+
+    def result(self) -> list[Sequence[float]]:
+        if not self._done:
+            self._value = self._finish()
+            self._done = True
+        return self._value
+
+
+class CachedEmbedder:
+    """在 embedder 外面套一层缓存：只有缓存未命中的文本才会送进模型。
+
+    对外暴露和 `LocalQwenEmbedder` 一致的 `encode` / `encode_async` / `token_lengths`，
+    可以直接替换原来的 embedder 使用。
+    """
+
+    def __init__(self, embedder, cache: EmbeddingCache) -> None:
+        self.embedder = embedder
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def parallelism(self) -> int:
+        return getattr(self.embedder, "parallelism", 1)
+
+    @property
+    def stats(self) -> dict:
+        return getattr(self.embedder, "stats", {})
+
+    def encode(self, texts: list[str]) -> list[Sequence[float]]:
+        return self.encode_async(texts).result()
+
+    def encode_async(self, texts: list[str]) -> PendingEmbedding:
+        """先查缓存，只把未命中的文本提交给内层 embedder；结果在 `result()` 时合并并回写缓存。"""
+        keys = [hashlib.md5(text.encode("utf-8")).hexdigest() for text in texts]
+        cached = self.cache.get_many(keys) if keys else {}
+        # 同一批里重复的文本只算一次。
+        missing = list({key: index for index, key in enumerate(keys) if key not in cached}.values())
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if not missing:
+            return PendingEmbedding(lambda: [cached[key] for key in keys])
+
+        inner = self.embedder.encode_async([texts[index] for index in missing])
+
+        def finish() -> list[Sequence[float]]:
+            vectors = inner.result()
+            fresh = {keys[index]: vector for index, vector in zip(missing, vectors)}
+            self.cache.put_many(fresh)
+            cached.update(fresh)
+            return [cached[key] for key in keys]
+
+        return PendingEmbedding(finish)
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        return self.embedder.token_lengths(texts)
@@ -12,25 +12,39 @@ Usage:
 from __future__ import annotations
 
 import argparse
+import functools
 import hashlib
+import http.client
+import itertools
 import json
+import math
+import multiprocessing
 import os
+import random
 import re
 import sys
+import threading
 import time
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Iterable
-from urllib import parse, request
+from typing import Callable, Iterable, Iterator, Sequence, TypeVar
 
 import torch
 import torch.nn.functional as F
-from transformers import AutoModel, AutoTokenizer
+from transformers import AutoConfig, AutoModel, AutoTokenizer
 
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
+from embedding_artifact import EXPORT_DTYPES, EmbeddingArtifactWriter
+from embedding_cache import CachedEmbedder, EmbeddingCache, model_fingerprint
+from ingest_telemetry import IngestTelemetry, merge_embed_stats, new_embed_stats, peak_rss_bytes
+from postgres_copy import ROW_REJECTION_SQLSTATE_CLASSES, PostgresBulkLoader, PostgresCopyError, copy_rows
 from project_env import get_env, resolve_project_path
+from supabase_http import SupabaseHTTPError, shared_client
 
 DEFAULT_JSONL = (
     Path(
@@ -48,19 +62,68 @@ DEFAULT_MODEL_PATH = resolve_project_path(
     base_dir=PROJECT_ROOT,
 )
 DEFAULT_CHECKPOINT_FILE = Path(__file__).resolve().with_name(".ingest_local_qwen.checkpoint.json")
+DEFAULT_BENCHMARK_REPORT = Path(__file__).resolve().with_name(".ingest_local_qwen.benchmark.json")
+DEFAULT_DEAD_LETTER_FILE = Path(__file__).resolve().with_name(".ingest_local_qwen.dead_letter.jsonl")
 SURROGATE_RE = re.compile(r"[\ud800-\udfff]")
+# tokenizer 截断上限：不改变 chunk 切分策略，只防止极长文本把内存/显存顶得过高。
+EMBED_MAX_LENGTH = 8192
+# 接近截断上限的超长 chunk 在 token 预算模式下总是单独成批，避免拖着整批一起 padding。
+LONG_CHUNK_TOKENS = EMBED_MAX_LENGTH * 3 // 4
+# token 预算模式下没有指定 --length-bucket-window 时，每次读入这么多条 chunk 一起装箱。
+TOKEN_PACK_WINDOW = 256
+# embedding 推理后端：HF 原版 / CPU 动态 int8 量化 / 导出的 ONNX 图（onnxruntime）。
+EMBED_BACKENDS = ("torch", "torch-int8", "onnx")
+# 能无损还原 float32 的十进制有效数字位数。
+FLOAT32_DIGITS = 9
+# 额外 Matryoshka 维度写入的列名，例如 `embedding_256`；主维度仍写 `embedding`。
+EXTRA_DIM_COLUMN = "embedding_{dim}"
+# rag-setup.sql 里建好了对应列的额外维度；新增维度要先在 rag-setup.sql 加列，再加到这里。
+SUPPORTED_EXTRA_DIMS = (256, 512)
+# 增量入库按 id 批量 PATCH / DELETE 时每次请求带的 id 数，避免 URL 过长。
+INCREMENTAL_ID_BATCH = 500
+T = TypeVar("T")
+
+
+def validate_input_file(file_path: str) -> str | None:
+    """检查输入文件，有问题时返回错误信息。"""
+    path = Path(file_path)
+    if not path.exists():
+        return f"Knowledge file not found: {file_path}"
+    if path.suffix.lower() != ".jsonl":
+        return (
+            "Knowledge file must be a JSONL file (*.jsonl). "
+            f"Current value: {file_path}. "
+            "You likely pointed RAG_KNOWLEDGE_FILE to a non-knowledge file."
+        )
+    return None
 
 
 def parse_args() -> argparse.Namespace:
     """解析命令行参数：控制本地 embedding 到 Supabase 的入库行为。"""
     parser = argparse.ArgumentParser()
     parser.add_argument("--file", default=str(DEFAULT_JSONL), help="Path to filtered JSONL knowledge file")
+    parser.add_argument(
+        "--manifest",
+        default="",
+        help="JSON / YAML 任务清单，列出多组 (file, kb, dataset_version)；同一进程只加载一次模型依次入库",
+    )
     parser.add_argument("--supabase-url", default=os.getenv("SUPABASE_URL", ""), help="Supabase project URL")
     parser.add_argument(
         "--supabase-key",
         default=os.getenv("SUPABASE_SERVICE_ROLE_KEY", ""),
         help="Supabase service role key",
     )
+    parser.add_argument(
+        "--sink",
+        choices=("rest", "copy"),
+        default="rest",
+        help="写入方式：rest 走 PostgREST JSON upsert；copy 直连 Postgres，COPY 进临时表后合并，适合首次整版灌库",
+    )
+    parser.add_argument(
+        "--database-url",
+        default=os.getenv("SUPABASE_DB_URL", ""),
+        help="--sink copy 使用的 Postgres 连接串，默认读取 SUPABASE_DB_URL",
+    )
     parser.add_argument(
         "--model-path",
         default=DEFAULT_MODEL_PATH,
@@ -68,6 +131,15 @@ def parse_args() -> argparse.Namespace:
     )
     parser.add_argument("--batch-size", type=int, default=8, help="Embedding batch size")
     parser.add_argument("--dim", type=int, default=int(os.getenv("QWEN_EMBEDDING_DIM", "1024")), help="Output embedding dimension")
+    parser.add_argument(
+        "--extra-dims",
+        default=os.getenv("QWEN_EMBEDDING_EXTRA_DIMS", ""),
+        help=(
+            "额外输出的 Matryoshka 维度，逗号分隔，可选 "
+            + ",".join(str(dim) for dim in SUPPORTED_EXTRA_DIMS)
+            + "；与 --dim 共用一次前向，截断后重新归一化，分别写入 rag-setup.sql 建好的 embedding_<dim> 列"
+        ),
+    )
     parser.add_argument("--kb", default=os.getenv("RAG_KB_SLUG", "travel-cn-public"), help="Stable shared knowledge base slug")
     parser.add_argument(
         "--dataset-version",
@@ -80,24 +152,260 @@ def parse_args() -> argparse.Namespace:
         default=str(DEFAULT_CHECKPOINT_FILE),
         help="本地断点续跑状态文件路径",
     )
+    parser.add_argument("--num-shards", type=int, default=1, help="把输入切成 N 个互不重叠的分片，分给多台机器并行入库")
+    parser.add_argument("--shard-id", type=int, default=0, help="当前进程负责的分片编号，0 <= shard-id < num-shards")
+    parser.add_argument(
+        "--shard-by",
+        default="hash",
+        choices=["hash", "line"],
+        help="分片方式：hash 按 content_hash 取模（跨版本稳定），line 按物理行号取模（其他分片的行不解析，更快）",
+    )
+    parser.add_argument(
+        "--shard-status",
+        action="store_true",
+        help="不入库，只汇总各分片 checkpoint 并报告整体完成情况（需要能读到所有分片的 checkpoint 文件）",
+    )
+    parser.add_argument(
+        "--finalize-shards",
+        action="store_true",
+        help="不入库：确认所有分片的 checkpoint 都已 completed 后，执行 --incremental-from 的全局改标和删除"
+        "（分片入库时各分片都不做这一步）",
+    )
     parser.add_argument(
         "--reset-checkpoint",
         action="store_true",
         help="启动前清除当前任务的本地 checkpoint，从头开始跑",
     )
+    parser.add_argument(
+        "--embed-backend",
+        default=os.getenv("QWEN_EMBEDDING_BACKEND", "torch"),
+        choices=EMBED_BACKENDS,
+        help="embedding 推理后端：torch（HF 原版）、torch-int8（CPU 动态 int8 量化）、onnx（onnxruntime）",
+    )
+    parser.add_argument(
+        "--onnx-model",
+        default=os.getenv("QWEN_EMBEDDING_ONNX_PATH", ""),
+        help="onnx 后端使用的 .onnx 文件，默认 <model-path>/onnx/model.onnx；可以是 onnxruntime 量化后的模型",
+    )
+    parser.add_argument(
+        "--verify-backend",
+        type=int,
+        default=0,
+        help="开始入库前，取前 N 条 chunk 对比所选后端与 fp32 参考模型的余弦一致性，0 表示不检查",
+    )
+    parser.add_argument(
+        "--verify-min-cosine",
+        type=float,
+        default=0.99,
+        help="--verify-backend 的最低可接受余弦相似度，低于该值则中止",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="CPU embedding 进程数；每个进程常驻一份模型并绑定各自的 CPU 核，注意内存占用按进程数成倍增加",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=0,
+        help="每个 embedding 进程的 torch 线程数，0 表示按可用核数平均分配",
+    )
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=0,
+        help="单次前向的 padding 后 token 预算（条数 x 批内最长长度）；启用后前向批次按预算在分桶窗口"
+        f"（未设置时为 {TOKEN_PACK_WINDOW} 条）内装箱，短 chunk 可以远多于 --batch-size 条一起前向，"
+        "--batch-size 只决定上传和 checkpoint 的批次；0 表示关闭",
+    )
+    parser.add_argument(
+        "--length-bucket-window",
+        type=int,
+        default=0,
+        help="按 token 长度分桶的窗口大小（条数），例如 256；窗口内先按长度排序再切批以减少 padding，0 表示关闭",
+    )
+    parser.add_argument(
+        "--embedding-cache",
+        default=os.getenv("RAG_EMBEDDING_CACHE", ""),
+        help="SQLite 向量缓存文件路径，按 (content_hash, 模型, dim) 复用历史向量；为空表示不启用",
+    )
+    parser.add_argument(
+        "--embedding-cache-max-mb",
+        type=int,
+        default=4096,
+        help="向量缓存容量上限（MB），超出后淘汰最久未使用的向量",
+    )
+    parser.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="启动时批量拉取该 KB 已有的 content_hash，已存在的 chunk 不再做 embedding",
+    )
+    parser.add_argument(
+        "--incremental-from",
+        default="",
+        help="增量入库：与该 dataset_version 按 external_id / content_hash 对比，只 embed 新增或变更的 chunk，"
+        "未变化的行沿用已有向量并改标为当前版本，旧版本中已删除的行在入库完成后删除",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=2,
+        help="后台写入 Supabase 的线程数；embedding 与上传并行进行",
+    )
+    parser.add_argument(
+        "--max-pending-batches",
+        type=int,
+        default=4,
+        help="在途 upsert 请求数上限，超过后主线程会等待上传完成",
+    )
+    parser.add_argument("--upsert-rows", type=int, default=64, help="单次 upsert 的初始行数，之后按实际耗时自动调整")
+    parser.add_argument("--upsert-max-rows", type=int, default=1000, help="单次 upsert 的行数上限")
+    parser.add_argument(
+        "--upsert-max-bytes",
+        type=int,
+        default=8 * 1024 * 1024,
+        help="单次 upsert 请求体的目标上限（字节），按观测到的平均行大小折算成行数",
+    )
+    parser.add_argument(
+        "--upsert-target-seconds",
+        type=float,
+        default=2.0,
+        help="单次 upsert 的目标耗时；明显更快就加大批量，更慢就缩小",
+    )
+    parser.add_argument("--upsert-retries", type=int, default=5, help="5xx / 超时等临时错误的最大重试次数")
+    parser.add_argument(
+        "--vector-precision",
+        type=int,
+        default=FLOAT32_DIGITS,
+        help="写入时向量每个分量保留的有效数字位数；9 为 float32 无损，4 约等于半精度、请求体更小",
+    )
+    parser.add_argument(
+        "--dead-letter-file",
+        default=str(DEFAULT_DEAD_LETTER_FILE),
+        help="因数据本身被数据库拒绝的行（约束冲突、数据异常等）会二分定位后写入这个 JSONL，其余行照常入库；"
+        "任务记为 incomplete，修好后重跑同一命令只重试这些行",
+    )
+    parser.add_argument(
+        "--http-gzip-requests",
+        action="store_true",
+        help="gzip 压缩写入请求体（需要 Supabase 网关接受 Content-Encoding: gzip）",
+    )
+    parser.add_argument(
+        "--export-dir",
+        default="",
+        help="同时把向量导出到该目录（vectors.npy + ids.jsonl + manifest.json），可被 numpy 直接 mmap",
+    )
+    parser.add_argument(
+        "--export-dtype",
+        default="float32",
+        choices=sorted(EXPORT_DTYPES),
+        help="导出向量的精度；int8 为按行对称量化，另存 scales.npy",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default="",
+        help="逐批写出各阶段耗时（tokenize / forward / pool / build_rows / 序列化 / upsert / checkpoint）、"
+        "token 数和内存峰值；*.prom / *.txt 写 OpenMetrics，其他写 JSONL",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="不入库，用 JSONL 前若干条 chunk 扫一遍 batch size / dim / 线程数 / 分桶组合，报告吞吐、延迟和内存并给出推荐配置",
+    )
+    parser.add_argument("--benchmark-sample", type=int, default=256, help="benchmark 使用的 chunk 条数")
+    parser.add_argument("--benchmark-batch-sizes", default="4,8,16,32", help="benchmark 扫描的 batch size，逗号分隔")
+    parser.add_argument("--benchmark-dims", default="", help="benchmark 扫描的输出维度，逗号分隔，默认只测 --dim")
+    parser.add_argument(
+        "--benchmark-threads",
+        default="0",
+        help="benchmark 扫描的 torch 线程数，逗号分隔，0 表示 torch 默认值",
+    )
+    parser.add_argument(
+        "--benchmark-bucket-windows",
+        default="0,256",
+        help="benchmark 扫描的长度分桶窗口，逗号分隔，0 表示不分桶",
+    )
+    parser.add_argument(
+        "--benchmark-report",
+        default=str(DEFAULT_BENCHMARK_REPORT),
+        help="benchmark JSON 报告输出路径",
+    )
     parser.add_argument("--dry-run", action="store_true", help="Only embed and validate, do not write to Supabase")
     args = parser.parse_args()
     if not args.model_path:
         parser.error("Missing embedding model path. Set QWEN_EMBEDDING_MODEL_PATH in .env or pass --model-path.")
-    file_path = Path(args.file)
-    if not file_path.exists():
-        parser.error(f"Knowledge file not found: {args.file}")
-    if file_path.suffix.lower() != ".jsonl":
+    if args.manifest:
+        if not Path(args.manifest).exists():
+            parser.error(f"Manifest not found: {args.manifest}")
+        if args.shard_status or args.finalize_shards:
+            parser.error("--shard-status / --finalize-shards do not support --manifest")
+    else:
+        file_error = validate_input_file(args.file)
+        if file_error:
+            parser.error(file_error)
+    try:
+        args.extra_dims = sorted({int(item) for item in args.extra_dims.split(",") if item.strip()})
+    except ValueError:
+        parser.error("--extra-dims must be a comma-separated list of integers")
+    if args.dim <= 0 or any(dim <= 0 for dim in args.extra_dims):
+        parser.error("--dim and --extra-dims must be positive")
+    if args.dim in args.extra_dims:
+        parser.error(f"--extra-dims must not repeat --dim {args.dim}")
+    unsupported = [dim for dim in args.extra_dims if dim not in SUPPORTED_EXTRA_DIMS]
+    if unsupported:
         parser.error(
-            "Knowledge file must be a JSONL file (*.jsonl). "
-            f"Current value: {args.file}. "
-            "You likely pointed RAG_KNOWLEDGE_FILE to a non-knowledge file."
+            f"--extra-dims {','.join(map(str, unsupported))} has no embedding_<dim> column in rag-setup.sql; "
+            f"supported: {','.join(map(str, SUPPORTED_EXTRA_DIMS))}"
         )
+    if args.embed_backend != "torch" and args.device == "cuda":
+        parser.error(f"--embed-backend {args.embed_backend} only supports CPU")
+    if args.verify_backend < 0:
+        parser.error("--verify-backend must be >= 0")
+    if args.num_shards < 1:
+        parser.error("--num-shards must be >= 1")
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error("--shard-id must be in [0, --num-shards)")
+    if args.finalize_shards and not args.incremental_from:
+        parser.error("--finalize-shards requires --incremental-from")
+    if args.workers < 1:
+        parser.error("--workers must be >= 1")
+    if args.benchmark:
+        for name in ("benchmark_batch_sizes", "benchmark_dims", "benchmark_threads", "benchmark_bucket_windows"):
+            try:
+                values = [int(item) for item in getattr(args, name).split(",") if item.strip()]
+            except ValueError:
+                parser.error(f"--{name.replace('_', '-')} must be a comma-separated list of integers")
+            if any(value < 0 for value in values):
+                parser.error(f"--{name.replace('_', '-')} must not contain negative values")
+            setattr(args, name, values)
+        args.benchmark_dims = args.benchmark_dims or [args.dim]
+        if not args.benchmark_batch_sizes or 0 in args.benchmark_batch_sizes + args.benchmark_dims:
+            parser.error("--benchmark-batch-sizes and --benchmark-dims must be positive")
+        if args.benchmark_sample < 1:
+            parser.error("--benchmark-sample must be >= 1")
+        if args.workers > 1 or args.manifest:
+            parser.error("--benchmark runs a single in-process embedder; drop --workers / --manifest")
+    if args.workers > 1 and args.device == "cuda":
+        parser.error("--workers > 1 only supports CPU embedding")
+    if args.threads_per_worker < 0:
+        parser.error("--threads-per-worker must be >= 0")
+    if args.max_batch_tokens < 0:
+        parser.error("--max-batch-tokens must be >= 0")
+    if args.length_bucket_window < 0:
+        parser.error("--length-bucket-window must be >= 0")
+    if args.sink == "copy" and not args.database_url:
+        parser.error("--sink copy requires --database-url or SUPABASE_DB_URL")
+    if args.upload_workers < 1:
+        parser.error("--upload-workers must be >= 1")
+    if args.max_pending_batches < 1:
+        parser.error("--max-pending-batches must be >= 1")
+    if args.upsert_rows < 1 or args.upsert_max_rows < args.upsert_rows:
+        parser.error("--upsert-rows must be >= 1 and <= --upsert-max-rows")
+    if not 1 <= args.vector_precision <= FLOAT32_DIGITS:
+        parser.error(f"--vector-precision must be between 1 and {FLOAT32_DIGITS}")
+    if args.upsert_retries < 0:
+        parser.error("--upsert-retries must be >= 0")
     return args
 
 
@@ -140,12 +448,23 @@ def build_job_key(args: argparse.Namespace, dataset_version: str) -> str:
             "model_path": str(Path(args.model_path).resolve()),
             "dim": args.dim,
             "batch_size": args.batch_size,
+            # 只在启用时加入，保证已有任务的 key 不变、旧 checkpoint 仍然命中。
+            **({"extra_dims": args.extra_dims} if args.extra_dims else {}),
         },
         ensure_ascii=True,
         sort_keys=True,
     )
 
 
+def embedding_output_dim(args: argparse.Namespace) -> int:
+    """模型实际输出的维度：主维度和额外维度里最大的那个，其余维度都从它截断得到。"""
+    return max([args.dim, *args.extra_dims])
+
+
+def is_vector_column(column: str) -> bool:
+    return column == "embedding" or column.startswith("embedding_")
+
+
 def load_checkpoint_file(checkpoint_path: Path) -> dict:
     """读取 checkpoint 文件；文件不存在时返回空结构。"""
     if not checkpoint_path.exists():
@@ -160,33 +479,171 @@ def save_checkpoint_file(checkpoint_path: Path, payload: dict) -> None:
     temp_path = checkpoint_path.with_suffix(checkpoint_path.suffix + ".tmp")
     with temp_path.open("w", encoding="utf-8") as handle:
         json.dump(payload, handle, ensure_ascii=False, indent=2)
+        handle.flush()
+        os.fsync(handle.fileno())
     temp_path.replace(checkpoint_path)
 
 
-def get_job_checkpoint(store: dict, job_key: str) -> dict:
-    """取出某个任务的 checkpoint；没有就返回默认值。"""
-    jobs = store.setdefault("jobs", {})
-    return jobs.get(
-        job_key,
-        {
-            "status": "new",
-            "last_success_batch": 0,
-            "last_success_row": 0,
-            "written_rows": 0,
-        },
-    )
+def new_job_checkpoint() -> dict:
+    """新任务的默认 checkpoint。
 
+    `next_offset` 是 JSONL 中下一行未处理数据的字节偏移，续跑时直接 seek 过去，
+    不再需要把前面的批次重新解析一遍再跳过。
+    """
+    return {
+        "status": "new",
+        "next_offset": 0,
+        "last_success_row": 0,
+        "written_rows": 0,
+    }
+
+
+def finish_job_checkpoint(state: dict, rejected_hashes: list[str]) -> dict:
+    """任务跑到文件末尾时的最终状态；有被拒绝的行就记为 `incomplete`，下次运行只重试这些行。"""
+    finished = {
+        "status": "incomplete" if rejected_hashes else "completed",
+        "next_offset": state["next_offset"],
+        "last_success_row": int(state.get("last_success_row", 0)),
+        "written_rows": int(state.get("written_rows", 0)),
+    }
+    if rejected_hashes:
+        finished["rejected_hashes"] = sorted(set(rejected_hashes))
+    return finished
+
+
+def journal_path_for(checkpoint_path: Path) -> Path:
+    return checkpoint_path.with_suffix(checkpoint_path.suffix + ".journal")
 
-def set_job_checkpoint(store: dict, job_key: str, state: dict) -> None:
-    """更新某个任务的 checkpoint 内容。"""
-    jobs = store.setdefault("jobs", {})
-    jobs[job_key] = state
 
+def replay_journal(journal_path: Path, jobs: dict[str, dict]) -> None:
+    """把日志里的更新按顺序应用到 `jobs`。"""
+    with journal_path.open("r", encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断时最后一行可能只写了一半。
+                break
+            if entry["state"] is None:
+                jobs.pop(entry["job"], None)
+            else:
+                jobs[entry["job"]] = entry["state"]
+
+
+def read_checkpoint_state(checkpoint_path: Path, job_key: str) -> dict | None:
+    """只读地取出某个任务的最新 checkpoint（快照 + 日志），不触发合并写盘。"""
+    jobs = load_checkpoint_file(checkpoint_path).setdefault("jobs", {})
+    if journal_path_for(checkpoint_path).exists():
+        replay_journal(journal_path_for(checkpoint_path), jobs)
+    return jobs.get(job_key)
 
-def batched(items: list[dict], size: int) -> Iterable[list[dict]]:
-    """按固定大小切分批次，避免 embedding 和上传阶段占用过多内存。"""
-    for index in range(0, len(items), size):
-        yield items[index:index + size]
+
+class CheckpointJournal:
+    """checkpoint 快照 + 追加写日志。
+
+    快照仍是原来的 `{"jobs": {...}}` JSON 文件；每批提交只往旁边的 `.journal` 追加一行
+    `{"job": ..., "state": ...}`，开销与历史任务数量无关。
+
+    - 每次追加都会 flush 到操作系统，进程崩溃不丢；`fsync` 按时间间隔批量做，
+      断电最多回退到几秒前的偏移，重跑这几批是幂等的
+    - 日志行数达到 `compact_entries`、启动时发现旧日志、任务结束时，合并回快照并清空日志
+    """
+
+    def __init__(self, checkpoint_path: Path, fsync_seconds: float = 2.0, compact_entries: int = 1000) -> None:
+        self.path = checkpoint_path
+        self.journal_path = journal_path_for(checkpoint_path)
+        self.fsync_seconds = fsync_seconds
+        self.compact_entries = compact_entries
+        self.store = load_checkpoint_file(checkpoint_path)
+        self.jobs: dict[str, dict] = self.store.setdefault("jobs", {})
+        self.entries = 0
+        self._handle = None
+        self._last_sync = time.monotonic()
+        if self.journal_path.exists():
+            # 上次没有正常收尾（日志末尾可能还有半行），先合并成干净的快照再继续追加。
+            replay_journal(self.journal_path, self.jobs)
+            self.compact()
+
+    def get(self, job_key: str) -> dict:
+        """取出某个任务的 checkpoint；没有就返回默认值。"""
+        return self.jobs.get(job_key, new_job_checkpoint())
+
+    def set(self, job_key: str, state: dict) -> None:
+        self.jobs[job_key] = state
+        self._append({"job": job_key, "state": state})
+
+    def remove(self, job_key: str) -> None:
+        self.jobs.pop(job_key, None)
+        self._append({"job": job_key, "state": None})
+
+    def _append(self, entry: dict) -> None:
+        if self._handle is None:
+            self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+            self._handle = self.journal_path.open("a", encoding="utf-8")
+        self._handle.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+        self._handle.write("\n")
+        self._handle.flush()
+        self.entries += 1
+        if self.entries >= self.compact_entries:
+            self.compact()
+        elif time.monotonic() - self._last_sync >= self.fsync_seconds:
+            self.sync()
+
+    def sync(self) -> None:
+        if self._handle is not None:
+            os.fsync(self._handle.fileno())
+        self._last_sync = time.monotonic()
+
+    def compact(self) -> None:
+        """把当前状态写成快照并清空日志；顺序保证任意时刻崩溃都能恢复到最新状态。"""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        save_checkpoint_file(self.path, self.store)
+        self.journal_path.unlink(missing_ok=True)
+        self.entries = 0
+        self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        self.compact()
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    """按固定大小切分批次；输入可以是生成器，整个过程只持有当前这一批。"""
+    batch: list[T] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def plan_token_batches(lengths: list[int], max_batch_tokens: int) -> list[list[int]]:
+    """按 padding 后 token 预算把一批文本拆成若干子批，返回每个子批的下标。
+
+    先按长度排序再贪心装箱，子批代价按 `条数 x 批内最长长度` 计算，
+    与左 padding 后真正送进模型的张量大小一致。单条超过预算或接近截断上限的
+    chunk 独占一个子批，这样峰值内存始终受预算约束，不会被个别长文本拉高。
+    """
+    groups: list[list[int]] = []
+    current: list[int] = []
+    current_max = 0
+    for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+        length = lengths[index]
+        if length >= LONG_CHUNK_TOKENS or length >= max_batch_tokens:
+            groups.append([index])
+            continue
+        padded_max = max(current_max, length)
+        if current and (len(current) + 1) * padded_max > max_batch_tokens:
+            groups.append(current)
+            current, padded_max = [], length
+        current.append(index)
+        current_max = padded_max
+    if current:
+        groups.append(current)
+    return groups
 
 
 def last_token_pool(last_hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
@@ -210,10 +667,25 @@ class LocalQwenEmbedder:
     就能拿到已经归一化、可直接写入 pgvector / Supabase 的向量。
     """
 
-    def __init__(self, model_path: str, dim: int, device: str) -> None:
+    def __init__(
+        self,
+        model_path: str,
+        dim: int,
+        device: str,
+        max_batch_tokens: int = 0,
+        backend: str = "torch",
+        onnx_model: str = "",
+    ) -> None:
+        if backend not in EMBED_BACKENDS:
+            raise ValueError(f"Unsupported embedding backend: {backend}")
         self.model_path = model_path
         self.dim = dim
-        self.device = self._resolve_device(device)
+        self.max_batch_tokens = max_batch_tokens
+        self.backend = backend
+        # 量化 / ONNX 后端只跑 CPU，auto 时直接落到 CPU。
+        self.device = "cpu" if backend != "torch" and device == "auto" else self._resolve_device(device)
+        if backend != "torch" and self.device != "cpu":
+            raise ValueError(f"Embedding backend {backend} only supports CPU")
         # Qwen embedding 官方示例使用左侧 padding，这里保持一致。
         self.tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -221,18 +693,47 @@ class LocalQwenEmbedder:
             padding_side="left",
         )
 
-        model_kwargs = {"trust_remote_code": True}
-        if self.device == "cuda":
-            # 在 GPU 上优先使用 bf16，通常能降低显存占用，同时保持较好的吞吐。
-            model_kwargs["torch_dtype"] = torch.bfloat16
-
-        self.model = AutoModel.from_pretrained(model_path, **model_kwargs).to(self.device)
-        self.model.eval()
-
-        hidden_size = int(getattr(self.model.config, "hidden_size", 0) or 0)
+        # tokenize / forward / pool 的累计耗时和 token 数，供 telemetry 按批取增量。
+        self.stats = new_embed_stats()
+        self.model = None
+        self.session = None
+        if backend == "onnx":
+            self.session = self._load_onnx_session(onnx_model or default_onnx_model_path(model_path))
+            config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+        else:
+            model_kwargs = {"trust_remote_code": True}
+            if self.device == "cuda":
+                # 在 GPU 上优先使用 bf16，通常能降低显存占用，同时保持较好的吞吐。
+                model_kwargs["torch_dtype"] = torch.bfloat16
+
+            self.model = AutoModel.from_pretrained(model_path, **model_kwargs).to(self.device)
+            self.model.eval()
+            if backend == "torch-int8":
+                # 动态量化：Linear 权重离线转 int8，激活在推理时按批量化，CPU 上省内存带宽。
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            config = self.model.config
+
+        hidden_size = int(getattr(config, "hidden_size", 0) or 0)
         if hidden_size and dim > hidden_size:
             raise ValueError(f"Requested dim {dim} exceeds model hidden size {hidden_size}")
 
+    @staticmethod
+    def _load_onnx_session(onnx_path: str):
+        try:
+            import onnxruntime as ort
+        except ImportError as exc:
+            raise RuntimeError("Embedding backend onnx requires onnxruntime: pip install onnxruntime") from exc
+        if not Path(onnx_path).exists():
+            raise RuntimeError(
+                f"ONNX model not found: {onnx_path}. Export it first, e.g. "
+                "`optimum-cli export onnx --model <model-path> --task feature-extraction <model-path>/onnx`."
+            )
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 与 torch 共用线程设置，多进程模式下每个 worker 的线程数由 --threads-per-worker 控制。
+        options.intra_op_num_threads = torch.get_num_threads()
+        return ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+
     @staticmethod
     def _resolve_device(device: str) -> str:
         """将 auto 解析成具体设备：优先 CUDA，没有就退回 CPU。"""
@@ -242,30 +743,49 @@ class LocalQwenEmbedder:
             raise RuntimeError("CUDA requested but not available")
         return device
 
-    @torch.inference_mode()
-    def encode(self, texts: list[str]) -> list[list[float]]:
+    def encode(self, texts: list[str]) -> list[Sequence[float]]:
         """对一批文本做 embedding，并返回 L2 归一化后的向量。
 
+        设置了 `max_batch_tokens` 时，会先按 token 预算把这批文本拆成若干子批
+        分别前向，再按输入顺序拼回结果。入库主流程在 `embed_batches` 里装批，构造 embedder 时
+        不传预算；这里留给直接调用 `encode`、又希望限制峰值内存的场景。
+        """
+        if not texts:
+            return []
+        if self.max_batch_tokens <= 0:
+            return self._encode_batch(texts)
+
+        vectors: list[Sequence[float]] = [[] for _ in texts]
+        for group in plan_token_batches(self.token_lengths(texts), self.max_batch_tokens):
+            for index, vector in zip(group, self._encode_batch([texts[index] for index in group])):
+                vectors[index] = vector
+        return vectors
+
+    @torch.inference_mode()
+    def _encode_batch(self, texts: list[str]) -> list[Sequence[float]]:
+        """对一个子批做单次前向。
+
         当需要截断维度时，会做两次归一化：
         1. 先对完整 hidden vector 做归一化
         2. 再截到目标维度
         3. 再归一化一次，保证余弦相似度仍然可用
         """
-        if not texts:
-            return []
-
-        # `max_length` 是 tokenizer 的截断上限。
-        # 它不会改变你的 chunk 切分策略，只是防止极长文本在 embedding 时把内存/显存顶得过高。
+        started = time.perf_counter()
         tokenized = self.tokenizer(
             texts,
             padding=True,
             truncation=True,
-            max_length=8192,
+            max_length=EMBED_MAX_LENGTH,
             return_tensors="pt",
         )
         tokenized = {key: value.to(self.device) for key, value in tokenized.items()}
-        outputs = self.model(**tokenized)
-        embeddings = last_token_pool(outputs.last_hidden_state, tokenized["attention_mask"])
+        tokenized_at = time.perf_counter()
+        hidden_states = self._forward(tokenized)
+        if self.device == "cuda":
+            # CUDA 是异步执行的，不同步的话 forward 耗时会被算进后面的池化。
+            torch.cuda.synchronize()
+        forwarded_at = time.perf_counter()
+        embeddings = last_token_pool(hidden_states, tokenized["attention_mask"])
         embeddings = F.normalize(embeddings, p=2, dim=1)
 
         if self.dim < embeddings.shape[1]:
@@ -273,35 +793,506 @@ class LocalQwenEmbedder:
             embeddings = embeddings[:, : self.dim]
             embeddings = F.normalize(embeddings, p=2, dim=1)
 
-        return embeddings.float().cpu().tolist()
+        # 直接从连续内存切出每行的 float32 缓冲区，不为每个分量创建 Python float。
+        matrix = embeddings.float().cpu().contiguous().numpy()
+        vectors = [array("f", row.tobytes()) for row in matrix]
+        self.stats["tokenize_seconds"] += tokenized_at - started
+        self.stats["forward_seconds"] += forwarded_at - tokenized_at
+        self.stats["pool_seconds"] += time.perf_counter() - forwarded_at
+        self.stats["real_tokens"] += int(tokenized["attention_mask"].sum())
+        self.stats["padded_tokens"] += int(tokenized["attention_mask"].numel())
+        return vectors
+
+    def _forward(self, tokenized: dict[str, torch.Tensor]) -> torch.Tensor:
+        """跑一次前向，返回 `last_hidden_state`。"""
+        if self.session is None:
+            return self.model(**tokenized).last_hidden_state
+
+        feeds = {}
+        for graph_input in self.session.get_inputs():
+            if graph_input.name in tokenized:
+                feeds[graph_input.name] = tokenized[graph_input.name].numpy()
+            elif graph_input.name == "position_ids":
+                # 左侧 padding：有效 token 的位置从 0 开始计数。
+                mask = tokenized["attention_mask"]
+                feeds["position_ids"] = (mask.cumsum(dim=1) - 1).clamp(min=0).numpy()
+        outputs = self.session.run(None, feeds)
+        return torch.from_numpy(outputs[0])
+
+    def encode_async(self, texts: list[str]) -> Future:
+        """与 `ParallelEmbedder.encode_async` 接口一致；单进程下直接同步算完。"""
+        future: Future = Future()
+        try:
+            future.set_result(self.encode(texts))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        """返回每条文本截断后的 token 数，用于按长度分桶；只做分词，不跑模型。"""
+        return tokenized_lengths(self.tokenizer, texts)
 
 
-def load_chunks(file_path: str) -> list[dict]:
-    """一次性把整个 JSONL 文件读入内存。
+def tokenized_lengths(tokenizer, texts: list[str]) -> list[int]:
+    """用 embedding tokenizer 计算每条文本截断后的 token 数。"""
+    if not texts:
+        return []
+    tokenized = tokenizer(texts, truncation=True, max_length=EMBED_MAX_LENGTH)
+    return [len(ids) for ids in tokenized["input_ids"]]
+
+
+def default_onnx_model_path(model_path: str) -> str:
+    """`optimum-cli export onnx` 的默认产物位置：`<model_path>/onnx/model.onnx`。"""
+    return str(Path(model_path) / "onnx" / "model.onnx")
+
+
+def cosine_agreement(reference: list[Sequence[float]], candidate: list[Sequence[float]]) -> list[float]:
+    """逐行计算两组向量的余弦相似度（两边都已 L2 归一化，点积即余弦）。"""
+    return [sum(a * b for a, b in zip(left, right)) for left, right in zip(reference, candidate)]
 
-    这种写法简单、容易调试，但代价是整个知识库文件会在入库期间常驻内存。
+
+def verify_backend(args: argparse.Namespace, entries: list[tuple[dict, int]]) -> LocalQwenEmbedder | None:
+    """用 fp32 torch 参考模型对样本做 embedding，与所选后端比较余弦一致性。
+
+    参考模型算完就释放，再加载目标后端，避免两份 4B 模型同时占内存。
+    两边都按入库实际输出的维度（含 `--extra-dims`）比较；通过时返回已加载的目标后端供入库直接使用，
+    不通过返回 `None`。与入库一样由 `embed_batches` 按 token 预算装批，模型本身不再做预算拆分。
     """
-    chunks: list[dict] = []
-    with open(file_path, "r", encoding="utf-8") as handle:
-        for line_no, raw in enumerate(handle, start=1):
-            raw = raw.strip()
+    dim = embedding_output_dim(args)
+    reference_model = LocalQwenEmbedder(args.model_path, dim, "cpu")
+    started = time.perf_counter()
+    reference = embed_entries(reference_model, entries, args.max_batch_tokens)
+    reference_seconds = time.perf_counter() - started
+    del reference_model
+    candidate_model = LocalQwenEmbedder(
+        args.model_path,
+        dim,
+        "cpu",
+        backend=args.embed_backend,
+        onnx_model=args.onnx_model,
+    )
+    started = time.perf_counter()
+    candidate = embed_entries(candidate_model, entries, args.max_batch_tokens)
+    candidate_seconds = time.perf_counter() - started
+
+    scores = sorted(cosine_agreement(reference, candidate))
+    mean = sum(scores) / len(scores)
+    print(
+        f"Backend check ({args.embed_backend} vs fp32, {len(scores)} samples, dim {dim}): "
+        f"mean cosine {mean:.5f}, min {scores[0]:.5f}, p5 {scores[len(scores) // 20]:.5f}, "
+        f"speedup {reference_seconds / max(candidate_seconds, 1e-6):.2f}x"
+    )
+    if scores[0] < args.verify_min_cosine:
+        print(
+            f"[error] backend {args.embed_backend} min cosine {scores[0]:.5f} "
+            f"is below --verify-min-cosine {args.verify_min_cosine}",
+            file=sys.stderr,
+        )
+        return None
+    # 验证样本的耗时和 token 数不计入入库的 telemetry。
+    candidate_model.stats = new_embed_stats()
+    return candidate_model
+
+
+_WORKER_EMBEDDER: LocalQwenEmbedder | None = None
+
+
+def embedding_cache_namespace(model_path: str, dim: int, backend: str = "torch", onnx_model: str = "") -> str:
+    """向量缓存的命名空间；量化 / ONNX 后端的向量与 fp32 略有差异，单独存放。
+
+    `test_rag_local_qwen.py` 的查询向量缓存也用同一套命名空间。
+    """
+    namespace = f"{model_fingerprint(model_path)}|dim={dim}"
+    if backend == "onnx":
+        namespace += f"|backend=onnx:{Path(onnx_model or default_onnx_model_path(model_path)).resolve()}"
+    elif backend != "torch":
+        namespace += f"|backend={backend}"
+    return namespace
+
+
+def _init_embed_worker(
+    model_path: str,
+    dim: int,
+    max_batch_tokens: int,
+    backend: str,
+    onnx_model: str,
+    threads: int,
+    core_slots,
+) -> None:
+    """embedding 子进程初始化：绑定 CPU 核、固定线程数，然后加载一份常驻模型。"""
+    global _WORKER_EMBEDDER
+    cores = core_slots.get()
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    _WORKER_EMBEDDER = LocalQwenEmbedder(model_path, dim, "cpu", max_batch_tokens, backend, onnx_model)
+
+
+def _encode_in_worker(texts: list[str]) -> tuple[list[Sequence[float]], dict[str, float]]:
+    """返回向量和这一批的计时增量，由主进程汇总。"""
+    _WORKER_EMBEDDER.stats = new_embed_stats()
+    vectors = _WORKER_EMBEDDER.encode(texts)
+    return vectors, {**_WORKER_EMBEDDER.stats, "peak_rss_bytes": peak_rss_bytes()}
+
+
+class ParallelEmbedder:
+    """多进程 CPU embedding。
+
+    纯 CPU 的多核机器上，单个模型实例吃不满所有核；这里启动 N 个进程，
+    每个进程常驻一份模型、固定 `threads` 个 torch 线程并绑定一组互不重叠的核。
+    主进程只加载 tokenizer（用于长度分桶），批次通过 `encode_async` 分发，
+    由调用方按提交顺序取回结果。
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        dim: int,
+        workers: int,
+        threads_per_worker: int = 0,
+        max_batch_tokens: int = 0,
+        backend: str = "torch",
+        onnx_model: str = "",
+    ) -> None:
+        self.model_path = model_path
+        self.dim = dim
+        self.parallelism = workers
+        self.stats = {**new_embed_stats(), "worker_peak_rss_bytes": 0}
+        self._stats_lock = threading.Lock()
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            model_path,
+            trust_remote_code=True,
+            padding_side="left",
+        )
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count() or 1))
+        threads = threads_per_worker or max(1, len(cpus) // workers)
+        # spawn 启动：子进程不继承主进程里已初始化的 torch 线程池状态。
+        context = multiprocessing.get_context("spawn")
+        core_slots = context.Queue()
+        for slot in range(workers):
+            cores = cpus[slot * threads:(slot + 1) * threads]
+            core_slots.put(cores if len(cores) == threads else [])
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_embed_worker,
+            initargs=(model_path, dim, max_batch_tokens, backend, onnx_model, threads, core_slots),
+        )
+
+    def encode_async(self, texts: list[str]) -> Future:
+        result: Future = Future()
+
+        def finish(inner: Future) -> None:
+            error = inner.exception()
+            if error is not None:
+                result.set_exception(error)
+                return
+            vectors, stats = inner.result()
+            with self._stats_lock:
+                merge_embed_stats(self.stats, stats)
+                self.stats["worker_peak_rss_bytes"] = max(
+                    self.stats["worker_peak_rss_bytes"], stats["peak_rss_bytes"]
+                )
+            result.set_result(vectors)
+
+        self.executor.submit(_encode_in_worker, texts).add_done_callback(finish)
+        return result
+
+    def encode(self, texts: list[str]) -> list[Sequence[float]]:
+        return self.encode_async(texts).result()
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        return tokenized_lengths(self.tokenizer, texts)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_chunks(
+    file_path: str,
+    start_offset: int = 0,
+    keep_line: Callable[[int], bool] | None = None,
+) -> Iterator[tuple[dict, int]]:
+    """流式读取 JSONL，逐条产出 `(chunk, 该行结束处的字节偏移)`。
+
+    以二进制方式打开文件，偏移量就是真实的字节位置，可以直接写进 checkpoint；
+    续跑时从 `start_offset` seek 过去，内存占用与文件大小无关。
+    传入 `keep_line(物理行号)` 时，不保留的行直接跳过，连 JSON 都不解析（按行分片用）。
+    """
+    with open(file_path, "rb") as handle:
+        line_number = count_lines(file_path, start_offset) if keep_line is not None else 0
+        if start_offset:
+            handle.seek(start_offset)
+        offset = start_offset
+        while True:
+            raw = handle.readline()
             if not raw:
+                break
+            line_offset = offset
+            offset += len(raw)
+            line_number += 1
+            if keep_line is not None and not keep_line(line_number - 1):
+                continue
+            text = raw.decode("utf-8").strip()
+            if not text:
                 continue
             try:
-                chunks.append(json.loads(raw))
+                chunk = json.loads(text)
             except json.JSONDecodeError as exc:
-                print(f"[warn] skip invalid JSONL line {line_no}: {exc}", file=sys.stderr)
-    return chunks
+                print(f"[warn] skip invalid JSONL line at byte {line_offset}: {exc}", file=sys.stderr)
+                continue
+            yield chunk, offset
+
+
+def count_lines(file_path: str, end_offset: int) -> int:
+    """统计文件前 `end_offset` 字节里的换行数，即该偏移处的物理行号。"""
+    count = 0
+    remaining = end_offset
+    with open(file_path, "rb") as handle:
+        while remaining > 0:
+            block = handle.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            count += block.count(b"\n")
+            remaining -= len(block)
+    return count
+
+
+def shard_of_hash(content_hash: str, num_shards: int) -> int:
+    """按 `content_hash` 分片：同一内容无论在文件哪一行、哪个版本，都落在同一个分片。"""
+    return int(content_hash[:8], 16) % num_shards
+
+
+def shard_chunks(entries: Iterable[tuple[dict, int]], shard_id: int, num_shards: int) -> Iterator[tuple[dict, int]]:
+    """只保留 `content_hash` 属于当前分片的 chunk。"""
+    for chunk, offset in entries:
+        if shard_of_hash(md5_text(normalize_text(chunk.get("content"))), num_shards) == shard_id:
+            yield chunk, offset
+
+
+def line_shard_predicate(shard_id: int, num_shards: int) -> Callable[[int], bool] | None:
+    """按物理行号分片时给 `iter_chunks` 的 `keep_line`；不分片时返回 `None`，不必数行号。"""
+    if num_shards <= 1:
+        return None
+    return lambda line_number: line_number % num_shards == shard_id
+
+
+def shard_checkpoint_path(checkpoint_path: Path, shard_by: str, shard_id: int, num_shards: int) -> Path:
+    """每个分片一个独立的 checkpoint 文件，job key 不变，多台机器各写各的互不干扰。"""
+    if num_shards <= 1:
+        return checkpoint_path
+    return checkpoint_path.with_name(
+        f"{checkpoint_path.stem}.shard-{shard_by}-{shard_id}-of-{num_shards}{checkpoint_path.suffix}"
+    )
+
+
+def report_shard_status(args: argparse.Namespace, checkpoint_path: Path, job_key: str) -> int:
+    """汇总同一任务所有分片的 checkpoint；全部完成返回 0，否则返回 1。
+
+    分片跑在不同机器上时，把各自的 checkpoint 文件收集到同一目录（或放在共享盘上）再执行。
+    """
+    completed = processed = written = 0
+    for shard_id in range(args.num_shards):
+        path = shard_checkpoint_path(checkpoint_path, args.shard_by, shard_id, args.num_shards)
+        label = f"Shard {shard_id}/{args.num_shards}"
+        if not path.exists():
+            print(f"{label}: missing ({path})")
+            continue
+        state = read_checkpoint_state(path, job_key)
+        if state is None:
+            print(f"{label}: not started ({path})")
+            continue
+        completed += state.get("status") == "completed"
+        processed += int(state.get("last_success_row", 0))
+        written += int(state.get("written_rows", 0))
+        rejected = f", rejected {len(state['rejected_hashes'])}" if state.get("rejected_hashes") else ""
+        print(
+            f"{label}: {state.get('status')}, processed {state.get('last_success_row', 0)}, "
+            f"written {state.get('written_rows', 0)}{rejected}, next_offset {state.get('next_offset', 0)}"
+        )
+    print(
+        f"Merged: {completed}/{args.num_shards} shards completed, "
+        f"processed rows: {processed}, written rows: {written}"
+    )
+    return 0 if completed == args.num_shards else 1
+
+
+
+def check_resume_offset(file_path: str, offset: int) -> None:
+    """确认断点偏移仍然落在当前文件的某一行开头。
+
+    文件被替换或截断后，旧偏移可能指向行中间；这种情况直接报错，
+    避免从半行数据开始解析出一堆脏 chunk。
+    """
+    if offset <= 0:
+        return
+    size = Path(file_path).stat().st_size
+    if offset > size:
+        raise RuntimeError(
+            f"Checkpoint offset {offset} exceeds file size {size}; "
+            "the input file changed, rerun with --reset-checkpoint."
+        )
+    if offset == size:
+        # 最后一行可能没有换行符，读到文件末尾本身就是合法位置。
+        return
+    with open(file_path, "rb") as handle:
+        handle.seek(offset - 1)
+        if handle.read(1) != b"\n":
+            raise RuntimeError(
+                f"Checkpoint offset {offset} is not at a line boundary; "
+                "the input file changed, rerun with --reset-checkpoint."
+            )
+
+
+def load_chunks(file_path: str) -> list[dict]:
+    """一次性把整个 JSONL 文件读入内存。
+
+    入库主流程已经改用 `iter_chunks` 流式处理；这里保留给需要随机访问全部 chunk 的场景，
+    例如 `test_rag_local_qwen.py` 的完整性校验和抽样。
+    """
+    return [chunk for chunk, _ in iter_chunks(file_path)]
+
+
+def content_texts(entries: list[tuple[dict, int]]) -> list[str]:
+    """取出一组 `(chunk, offset)` 里要向量化的文本。
+
+    只对 `content` 做语义向量化；其他字段主要用于筛选、展示和回溯来源，不应该混进语义向量。
+    """
+    return [normalize_text(chunk.get("content")) for chunk, _ in entries]
+
+
+def plan_embedding_jobs(
+    embedder: LocalQwenEmbedder,
+    entries: Iterable[tuple[dict, int]],
+    batch_size: int,
+    bucket_window: int,
+    max_batch_tokens: int = 0,
+) -> Iterator[tuple[list[tuple[dict, int]], list[tuple[list[int], Future]]]]:
+    """把输入切成若干 job 并提交 embedding，产出 `(job 内按文件顺序的条目, [(子批下标, 待取结果)])`。
+
+    不分桶时一个 job 就是一个批次；分桶时一个 job 是一个窗口，窗口内按 token 长度排序后切批。
+    设置了 `max_batch_tokens` 时，窗口内改按 token 预算装箱，子批条数不再受 `batch_size` 限制。
+    """
+    if bucket_window <= 0 and max_batch_tokens <= 0:
+        for batch in batched(entries, batch_size):
+            yield batch, [(list(range(len(batch))), embedder.encode_async(content_texts(batch)))]
+        return
+
+    for window in batched(entries, bucket_window or max(TOKEN_PACK_WINDOW, batch_size)):
+        texts = content_texts(window)
+        lengths = embedder.token_lengths(texts)
+        if max_batch_tokens > 0:
+            groups = plan_token_batches(lengths, max_batch_tokens)
+        else:
+            groups = list(batched(sorted(range(len(window)), key=lengths.__getitem__), batch_size))
+        yield window, [(group, embedder.encode_async([texts[index] for index in group])) for group in groups]
+
+
+def finish_embedding_job(
+    window: list[tuple[dict, int]],
+    groups: list[tuple[list[int], Future]],
+    batch_size: int,
+) -> Iterator[tuple[list[tuple[dict, int]], list[Sequence[float]]]]:
+    """取回一个 job 的全部子批结果，放回文件顺序后按 `batch_size` 产出批次。"""
+    embeddings: list[Sequence[float]] = [[] for _ in window]
+    for group, pending in groups:
+        try:
+            vectors = pending.result()
+        except Exception:
+            batch_ids = [window[index][0].get("id") for index in group]
+            print(f"embedding failed for ids={batch_ids}", file=sys.stderr)
+            raise
+        for index, vector in zip(group, vectors):
+            embeddings[index] = vector
+    for start in range(0, len(window), batch_size):
+        yield window[start:start + batch_size], embeddings[start:start + batch_size]
+
+
+def embed_batches(
+    embedder: LocalQwenEmbedder,
+    entries: Iterable[tuple[dict, int]],
+    batch_size: int,
+    bucket_window: int = 0,
+    max_batch_tokens: int = 0,
+) -> Iterator[tuple[list[tuple[dict, int]], list[Sequence[float]]]]:
+    """按文件顺序产出 `(批次条目, 对应向量)`。
+
+    `bucket_window > 0` 时，每次读入一个窗口，按 token 长度排序后再切批送进模型，
+    让长度相近的文本一起 padding；算完后把向量放回原位置，仍按文件顺序、
+    按 `batch_size` 产出批次，所以 checkpoint 偏移的含义与不分桶时完全一致。
+
+    `max_batch_tokens > 0` 时，前向批次由 token 预算决定：窗口内的短 chunk 可以几十上百条
+    一起前向，长 chunk 则少量或单独成批；`batch_size` 只决定产出（上传、checkpoint）的批次大小。
+
+    多进程 embedder（`parallelism > 1`）下会提前提交约 2 倍进程数的子批，
+    让每个进程始终有活干；结果仍严格按提交顺序取回。
+    """
+    parallelism = getattr(embedder, "parallelism", 1)
+    max_in_flight = 2 * parallelism if parallelism > 1 else 1
+    queued: deque = deque()
+    in_flight = 0
+    for job in plan_embedding_jobs(embedder, entries, batch_size, bucket_window, max_batch_tokens):
+        queued.append(job)
+        in_flight += len(job[1])
+        while queued and in_flight >= max_in_flight:
+            window, groups = queued.popleft()
+            in_flight -= len(groups)
+            yield from finish_embedding_job(window, groups, batch_size)
+    while queued:
+        window, groups = queued.popleft()
+        yield from finish_embedding_job(window, groups, batch_size)
+
+
+def embed_entries(embedder, entries: list[tuple[dict, int]], max_batch_tokens: int = 0) -> list[Sequence[float]]:
+    """一次性算出一小组条目的向量（按输入顺序），装批方式与入库相同。"""
+    return [
+        vector
+        for _, vectors in embed_batches(embedder, entries, max(1, len(entries)), 0, max_batch_tokens)
+        for vector in vectors
+    ]
+
 
+def matryoshka_views(vectors: list[Sequence[float]], dims: list[int]) -> dict[int, list[Sequence[float]]]:
+    """把一批已归一化的向量截成多个维度，每个维度截断后重新做 L2 归一化。
 
-def build_rows(batch: list[dict], embeddings: list[list[float]], kb_slug: str, dataset_version: str) -> list[dict]:
+    归一化与缩放无关，所以从最大维度截断的结果与直接从完整 hidden vector 截断完全一致，
+    多个维度只需要一次前向。等于输入宽度的维度原样返回。
+    """
+    if not vectors:
+        return {dim: [] for dim in dims}
+    width = len(vectors[0])
+    flat = array("f")
+    for vector in vectors:
+        flat.extend(vector)
+    matrix = torch.frombuffer(flat, dtype=torch.float32).view(len(vectors), width)
+    views: dict[int, list[Sequence[float]]] = {}
+    for dim in dims:
+        if dim >= width:
+            views[dim] = vectors
+            continue
+        truncated = F.normalize(matrix[:, :dim], p=2, dim=1).contiguous().numpy()
+        views[dim] = [array("f", row.tobytes()) for row in truncated]
+    return views
+
+
+def build_rows(
+    batch: list[dict],
+    embeddings: list[Sequence[float]],
+    kb_slug: str,
+    dataset_version: str,
+    extra_embeddings: dict[str, list[Sequence[float]]] | None = None,
+) -> list[dict]:
     """把 JSONL chunk 和 embedding 向量拼成可写入 Supabase 的行。
 
     这里把 JSONL 视为“源数据”，数据库中的向量行只是它的派生产物。
     保留原始元数据，是为了后续导出、迁移、多人共享时不丢上下文。
+    `extra_embeddings` 是 `{列名: 向量列表}`，用于同时写入额外维度的向量列。
     """
     rows = []
-    for chunk, embedding in zip(batch, embeddings):
+    for index, (chunk, embedding) in enumerate(zip(batch, embeddings)):
         content = normalize_text(chunk.get("content"))
         rows.append(
             {
@@ -334,59 +1325,663 @@ def build_rows(batch: list[dict], embeddings: list[list[float]], kb_slug: str, d
                 },
             }
         )
+        for column, vectors in (extra_embeddings or {}).items():
+            rows[-1][column] = vectors[index]
     return rows
 
 
-def upsert_rows(supabase_url: str, supabase_key: str, rows: list[dict]) -> None:
-    """通过 PostgREST 把一批数据写入 Supabase。
+@functools.lru_cache(maxsize=16)
+def _vector_format(dim: int, precision: int) -> str:
+    return "[" + ",".join([f"%.{precision}g"] * dim) + "]"
+
+
+def vector_literal(vector: Sequence[float], precision: int = FLOAT32_DIGITS) -> str:
+    """把向量格式化成 pgvector 文本字面量 `[x1,x2,...]`。
+
+    整行只做一次 `%` 格式化，比 `json.dumps` 逐个输出 17 位的 double repr 快得多，体积也小一半以上。
+    `precision` 是有效数字位数：9 位可以无损还原 float32，4 位约等于半精度。
+
+    `tuple(vector)` 会给每个分量建一个 Python float，这是有意保留的：直接从 float32 缓冲区格式化的
+    numpy 路径反而更慢（1024 维每行：`%` 约 0.33ms，`savetxt` 约 0.5ms，`char.mod` 约 1.5ms，
+    `array2string` 约 7ms），它们内部同样逐个分量走 Python 层格式化；临时 float 随即释放，不会累积。
+    """
+    return _vector_format(len(vector), precision) % tuple(vector)
+
+
+def serialize_rows(rows: list[dict], vector_precision: int = FLOAT32_DIGITS) -> bytes:
+    """把一批行序列化成 PostgREST 请求体，向量列以 pgvector 文本字面量发送。"""
+    return json.dumps(
+        [
+            {
+                key: vector_literal(value, vector_precision) if is_vector_column(key) else value
+                for key, value in row.items()
+            }
+            for row in rows
+        ]
+    ).encode("utf-8")
+
+
+def vector_column_widths(args: argparse.Namespace) -> dict[str, int]:
+    """本次要写入的向量列及各自的维度。"""
+    return {"embedding": args.dim, **{EXTRA_DIM_COLUMN.format(dim=dim): dim for dim in args.extra_dims}}
+
+
+def check_vector_widths(args: argparse.Namespace) -> str | None:
+    """入库前确认表里各向量列的维度与本次输出一致，不一致时返回错误信息。
+
+    维度不符会让每一行都被拒绝，应该在加载模型之前就发现，而不是上传时逐批二分。
+    `--sink copy` 直接读列类型；走 PostgREST 时只能各取一行非空向量数长度，表还是空的就跳过。
+    """
+    expected = vector_column_widths(args)
+    actual: dict[str, int] = {}
+    if args.sink == "copy":
+        types = PostgresBulkLoader(args.database_url).column_types(list(expected))
+        for column in expected:
+            if column not in types:
+                return f"column {column} does not exist in public.travel_knowledge; run rag-setup.sql first"
+            match = re.fullmatch(r'(?:[\w"]+\.)?vector\((\d+)\)', types[column])
+            if match:
+                actual[column] = int(match.group(1))
+    else:
+        client = shared_client(args.supabase_url, args.supabase_key)
+        for column in expected:
+            try:
+                rows, _ = client.request_json(
+                    "GET",
+                    "/rest/v1/travel_knowledge",
+                    params={"select": column, column: "not.is.null", "limit": "1"},
+                )
+            except SupabaseHTTPError as exc:
+                return f"cannot read column {column} from public.travel_knowledge: {exc}"
+            if rows:
+                value = rows[0][column]
+                actual[column] = len(json.loads(value) if isinstance(value, str) else value)
+    for column, width in actual.items():
+        if width != expected[column]:
+            return (
+                f"column {column} stores {width}-dim vectors but this run writes {expected[column]} dims; "
+                "check --dim / --extra-dims against rag-setup.sql"
+            )
+    return None
+
+
+def upsert_payload(supabase_url: str, supabase_key: str, payload: bytes) -> None:
+    """通过 PostgREST 把已序列化的一批数据写入 Supabase。
 
     幂等键使用 `(kb_slug, content_hash)`，所以同一份数据重复执行入库不会重复插入。
+    请求走 `supabase_http` 的共享连接池，多个上传线程复用 keep-alive 连接。
     """
-    query = parse.urlencode({"on_conflict": "kb_slug,content_hash"})
-    url = f"{supabase_url.rstrip('/')}/rest/v1/travel_knowledge?{query}"
-    payload = json.dumps(rows).encode("utf-8")
-    req = request.Request(
-        url,
-        data=payload,
-        method="POST",
-        headers={
-            "Content-Type": "application/json",
-            "apikey": supabase_key,
-            "Authorization": f"Bearer {supabase_key}",
-            "Prefer": "resolution=ignore-duplicates,return=minimal",
-        },
+    shared_client(supabase_url, supabase_key).request_json(
+        "POST",
+        "/rest/v1/travel_knowledge",
+        params={"on_conflict": "kb_slug,content_hash"},
+        body=payload,
+        extra_headers={"Prefer": "resolution=ignore-duplicates,return=minimal"},
     )
-    with request.urlopen(req, timeout=120) as response:
-        if response.status >= 300:
-            raise RuntimeError(f"Supabase upsert failed: HTTP {response.status}")
 
 
-def main() -> int:
-    """入库主流程。
+def is_transient_error(exc: BaseException) -> bool:
+    """判断写入失败是否值得原样重试：网络层错误、超时、5xx、408/429。"""
+    if isinstance(exc, SupabaseHTTPError):
+        return exc.status >= 500 or exc.status in {408, 429}
+    if isinstance(exc, PostgresCopyError):
+        return exc.transient
+    return isinstance(exc, (OSError, http.client.HTTPException))
+
+
+def postgrest_error_code(exc: SupabaseHTTPError) -> str:
+    """取 PostgREST 错误响应体里的 `code`：数据库错误是 SQLSTATE，PostgREST 自身的错误是 `PGRSTxxx`。"""
+    try:
+        body = json.loads(exc.body)
+    except ValueError:
+        return ""
+    return str(body.get("code") or "") if isinstance(body, dict) else ""
+
+
+def is_row_rejection(exc: BaseException) -> bool:
+    """判断写入失败是否由个别坏行引起；只有这类错误才二分拆批、把坏行写进 dead-letter。
+
+    400 且 SQLSTATE 属于 22 类（数据异常，如非法字符）或 23 类（约束冲突）、409 和 413 算行级错误。
+    401 / 403（key 不对）、404（表或 RPC 不存在）、`PGRST204`（未知列）之类的错误每一行都会遇到，
+    二分只会把整个语料写进 dead-letter，这些错误直接中止入库。22 类里也有每行都会触发的配置错误
+    （例如向量维度与列不符），由入库前的 `check_vector_widths` 和 `UpsertPipeline` 的熔断兜住。
+    """
+    if isinstance(exc, SupabaseHTTPError):
+        if exc.status in {409, 413}:
+            return True
+        return exc.status == 400 and postgrest_error_code(exc).startswith(ROW_REJECTION_SQLSTATE_CLASSES)
+    if isinstance(exc, PostgresCopyError):
+        return exc.rejected
+    return False
+
+
+def rejection_sqlstate(exc: BaseException) -> str:
+    """行级错误对应的 SQLSTATE；413 这类只有 HTTP 状态码、没有 SQLSTATE 的返回空串。"""
+    if isinstance(exc, SupabaseHTTPError):
+        code = postgrest_error_code(exc)
+        return code if code[:2].isdigit() else ""
+    if isinstance(exc, PostgresCopyError):
+        return exc.sqlstate or ""
+    return ""
+
+
+class SystematicRejectionError(RuntimeError):
+    """看起来每一行都会被拒绝的错误（多半是配置问题），不再逐行二分，直接中止入库。"""
+
+    def __init__(self, reason: str, error: BaseException) -> None:
+        super().__init__(f"{reason}; aborting instead of bisecting every row: {error}")
+        self.error = error
+
+
+class RestUpsertSink:
+    """通过 PostgREST upsert 写入，请求体是 JSON。"""
+
+    def __init__(self, supabase_url: str, supabase_key: str, vector_precision: int = FLOAT32_DIGITS) -> None:
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.vector_precision = vector_precision
+
+    def serialize(self, rows: list[dict]) -> bytes:
+        return serialize_rows(rows, self.vector_precision)
+
+    def send(self, rows: list[dict], payload: bytes) -> None:
+        upsert_payload(self.supabase_url, self.supabase_key, payload)
+
+    def close(self) -> None:
+        pass
+
+
+class PostgresCopySink:
+    """直连 Postgres：`COPY` 进临时 staging 表，再按 `(kb_slug, content_hash)` 合并，见 `postgres_copy`。"""
+
+    def __init__(self, database_url: str, vector_precision: int = FLOAT32_DIGITS) -> None:
+        self.loader = PostgresBulkLoader(database_url)
+        self.vector_precision = vector_precision
+
+    def serialize(self, rows: list[dict]) -> bytes:
+        # 同一次运行里各行的列和顺序都来自 `build_rows`，以第一行为准。
+        columns = list(rows[0])
+        return copy_rows(
+            [
+                [
+                    vector_literal(row[column], self.vector_precision) if is_vector_column(column) else row[column]
+                    for column in columns
+                ]
+                for row in rows
+            ]
+        )
+
+    def send(self, rows: list[dict], payload: bytes) -> None:
+        self.loader.load(list(rows[0]), payload)
+
+    def close(self) -> None:
+        self.loader.close()
+
+
+class AdaptiveUpsertSizer:
+    """根据实际写入耗时和请求体大小，动态调整每次 upsert 的行数。
+
+    - 耗时明显低于目标就放大批量，高于目标就按比例缩小（单次调整限制在 0.5x ~ 2x）
+    - 同时按观测到的平均行大小，保证请求体不超过 `max_bytes`
+    - 遇到临时错误时直接减半，先让服务端缓过来
+    """
+
+    def __init__(self, initial_rows: int, max_rows: int, max_bytes: int, target_seconds: float) -> None:
+        self.target_rows = initial_rows
+        self.min_rows = min(8, initial_rows)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+        self.bytes_per_row = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, row_count: int, payload_bytes: int, seconds: float) -> None:
+        with self._lock:
+            per_row = payload_bytes / max(1, row_count)
+            self.bytes_per_row = per_row if not self.bytes_per_row else 0.8 * self.bytes_per_row + 0.2 * per_row
+            ratio = min(2.0, max(0.5, self.target_seconds / max(seconds, 1e-3)))
+            target = int(row_count * ratio)
+            if self.bytes_per_row:
+                target = min(target, int(self.max_bytes / self.bytes_per_row))
+            self.target_rows = min(self.max_rows, max(self.min_rows, target))
+
+    def shrink(self) -> None:
+        with self._lock:
+            self.target_rows = max(self.min_rows, self.target_rows // 2)
+
+
+class DeadLetterWriter:
+    """把被数据库拒绝的行追加写入 JSONL；向量本身可以重新生成，不写进文件。"""
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write(self, row: dict, error: BaseException) -> None:
+        record = {key: value for key, value in row.items() if not is_vector_column(key)}
+        record["error"] = str(error)
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as handle:
+                handle.write(json.dumps(record, ensure_ascii=False))
+                handle.write("\n")
+            self.count += 1
+
+
+class UpsertPipeline:
+    """把 Supabase 写入放到后台线程池，主线程继续做 embedding。
+
+    - embedding 批次先进缓冲区，攒够 `sizer.target_rows` 行（或缓冲太久）才发一次 upsert，
+      上传批量与 embedding 的 `--batch-size` 解耦
+    - 在途上传数受 `max_pending` 限制，相当于一个有界队列，向量不会在内存里无限堆积
+    - 临时错误按指数退避重试；因个别坏行被拒绝的批次二分拆开，定位到具体坏行后写入 dead-letter，
+      其余行照常写入；鉴权、表不存在、schema 不符这类整批都会失败的错误直接中止
+    - 被拒绝行的 `content_hash` 随 `on_commit` 交给调用方记进 checkpoint，之后可以只重试这些行
+    - 熔断：二分时两半（各至少两行）都以同一个 SQLSTATE 被拒，或者还没有任何一行写入成功时第一批就全部被拒，
+      都说明是每一行都会遇到的问题，抛 `SystematicRejectionError` 中止，而不是把整个语料写进 dead-letter；
+      只重试上次被拒行的轮次里关掉熔断
+    - 各上传批次可能乱序完成，但 `on_commit` 只沿着“连续完成”的前缀回调，
+      所以 checkpoint 记录的偏移之前一定全部处理完毕
+    - 重试耗尽等无法恢复的失败，会先等其余在途批次结束并提交能提交的部分，再抛出异常
+    """
+
+    # 缓冲区里最早的一行等待超过这个时间就直接发出，避免慢速 embedding 时行数迟迟攒不够。
+    max_buffer_seconds = 10.0
+
+    def __init__(
+        self,
+        sink: RestUpsertSink | PostgresCopySink,
+        workers: int,
+        max_pending: int,
+        on_commit: Callable[[int, int, int, list[str]], None],
+        sizer: AdaptiveUpsertSizer,
+        dead_letter: DeadLetterWriter,
+        retries: int,
+        telemetry: IngestTelemetry | None = None,
+        circuit_breaker: bool = True,
+    ) -> None:
+        self.sink = sink
+        self.max_pending = max_pending
+        self.on_commit = on_commit
+        self.sizer = sizer
+        self.dead_letter = dead_letter
+        self.retries = retries
+        self.telemetry = telemetry
+        self.circuit_breaker = circuit_breaker
+        # 本次运行是否已有任何一批写入成功；一行都还没写进去时，整批被拒更像配置错误。
+        self._accepted = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upsert")
+        self._pending: dict[Future, tuple[int, int, list]] = {}
+        self._finished: dict[int, tuple[int, int, int, list[str]]] = {}
+        self._next_commit = 1
+        self._next_upload = 1
+        self._buffer: list[dict] = []
+        self._buffer_ids: list = []
+        self._buffer_offset = 0
+        self._buffer_started = 0.0
+
+    def __enter__(self) -> "UpsertPipeline":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                self.flush()
+            else:
+                # 主线程已经出错：仍然等在途批次写完并推进 checkpoint，但不掩盖原始异常。
+                self._record(wait(list(self._pending)).done)
+                self._advance()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def add(self, rows: list[dict], end_offset: int, chunk_ids: list) -> None:
+        """把一个 embedding 批次的行放进缓冲区，够量后提交上传。"""
+        if not self._buffer:
+            self._buffer_started = time.monotonic()
+        self._buffer.extend(rows)
+        self._buffer_ids.extend(chunk_ids)
+        self._buffer_offset = end_offset
+        if (
+            len(self._buffer) >= self.sizer.target_rows
+            or time.monotonic() - self._buffer_started >= self.max_buffer_seconds
+        ):
+            self._submit_buffer()
+
+    def flush(self) -> None:
+        """提交缓冲区剩余行，并等待全部在途上传完成。"""
+        if self._buffer:
+            self._submit_buffer()
+        while self._pending:
+            self._collect(FIRST_COMPLETED)
+
+    def _submit_buffer(self) -> None:
+        while len(self._pending) >= self.max_pending:
+            self._collect(FIRST_COMPLETED)
+        rows, chunk_ids = self._buffer, self._buffer_ids
+        self._buffer, self._buffer_ids = [], []
+        future = self._executor.submit(self._upload, rows)
+        self._pending[future] = (self._next_upload, self._buffer_offset, chunk_ids)
+        self._next_upload += 1
+
+    def _upload(self, rows: list[dict]) -> tuple[int, list[str], float]:
+        """在工作线程里执行：返回 `(写入行数, 被拒绝行的 content_hash, 耗时)`。"""
+        started = time.monotonic()
+        try:
+            payload_bytes = self._send_with_retry(rows)
+        except Exception as exc:
+            if not is_row_rejection(exc):
+                raise
+            first_batch = not self._accepted
+            written, rejected = self._bisect(rows, exc)
+            if first_batch and not written and len(rows) > 1 and self.circuit_breaker:
+                reason = f"the first batch of {len(rows)} rows was rejected entirely"
+                raise SystematicRejectionError(reason, exc) from exc
+            return written, rejected, time.monotonic() - started
+        seconds = time.monotonic() - started
+        self.sizer.observe(len(rows), payload_bytes, seconds)
+        return len(rows), [], seconds
+
+    def _send_with_retry(self, rows: list[dict]) -> int:
+        # 只序列化一次，重试时复用同一个请求体。
+        started = time.perf_counter()
+        payload = self.sink.serialize(rows)
+        serialized_at = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                self.sink.send(rows, payload)
+                self._accepted = True
+                if self.telemetry is not None:
+                    self.telemetry.record(
+                        "upload",
+                        rows=len(rows),
+                        bytes=len(payload),
+                        retries=attempt,
+                        serialize_seconds=serialized_at - started,
+                        upsert_seconds=time.perf_counter() - serialized_at,
+                    )
+                return len(payload)
+            except Exception as exc:
+                if not is_transient_error(exc) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                delay = min(30.0, 0.5 * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                print(
+                    f"[warn] upsert of {len(rows)} rows failed ({exc}); "
+                    f"retry {attempt}/{self.retries} in {delay:.1f}s",
+                    file=sys.stderr,
+                )
+                self.sizer.shrink()
+                time.sleep(delay)
+
+    def _bisect(self, rows: list[dict], error: BaseException) -> tuple[int, list[str]]:
+        """被拒绝的批次不断二分重发，直到把坏行隔离成单行写进 dead-letter。"""
+        if len(rows) == 1:
+            self.dead_letter.write(rows[0], error)
+            print(
+                f"[warn] row external_id={rows[0].get('external_id')} rejected, written to dead-letter: {error}",
+                file=sys.stderr,
+            )
+            return 0, [rows[0]["content_hash"]]
+        written = 0
+        rejected: list[str] = []
+        failures: list[tuple[list[dict], BaseException]] = []
+        middle = len(rows) // 2
+        for part in (rows[:middle], rows[middle:]):
+            try:
+                self._send_with_retry(part)
+                written += len(part)
+            except Exception as exc:
+                if not is_row_rejection(exc):
+                    raise
+                failures.append((part, exc))
+        sqlstate = rejection_sqlstate(error)
+        # 两半都只有一行时，相邻两条坏行同样会满足条件，所以只对更大的批次熔断。
+        systematic = self.circuit_breaker and middle > 1 and len(failures) == 2 and sqlstate
+        if systematic and all(rejection_sqlstate(exc) == sqlstate for _, exc in failures):
+            reason = f"both halves of a {len(rows)}-row batch failed with SQLSTATE {sqlstate}"
+            raise SystematicRejectionError(reason, error) from error
+        for part, exc in failures:
+            part_written, part_rejected = self._bisect(part, exc)
+            written += part_written
+            rejected.extend(part_rejected)
+        return written, rejected
+
+    def _record(self, done: Iterable[Future]) -> list[tuple[int, list, BaseException]]:
+        failures = []
+        for future in done:
+            upload_index, end_offset, chunk_ids = self._pending.pop(future)
+            error = future.exception()
+            if error is not None:
+                failures.append((upload_index, chunk_ids, error))
+                continue
+            written, rejected, seconds = future.result()
+            self._finished[upload_index] = (end_offset, written + len(rejected), written, rejected)
+            rejected_note = f", {len(rejected)} rejected" if rejected else ""
+            print(
+                f"upload {upload_index}: wrote {written} rows{rejected_note} in {seconds:.2f}s "
+                f"(next target {self.sizer.target_rows} rows)"
+            )
+        return failures
+
+    def _advance(self) -> None:
+        while self._next_commit in self._finished:
+            end_offset, processed, written, rejected = self._finished.pop(self._next_commit)
+            self.on_commit(end_offset, processed, written, rejected)
+            self._next_commit += 1
+
+    def _collect(self, return_when: str) -> None:
+        failures = self._record(wait(list(self._pending), return_when=return_when).done)
+        if failures and self._pending:
+            failures.extend(self._record(wait(list(self._pending)).done))
+        self._advance()
+        if failures:
+            failures.sort(key=lambda item: item[0])
+            for upload_index, chunk_ids, _ in failures:
+                print(f"upload {upload_index}: failed for ids={chunk_ids}", file=sys.stderr)
+            raise failures[0][2]
+
+
+def fetch_kb_rows(supabase_url: str, supabase_key: str, kb_slug: str, columns: str = "id,content_hash") -> list[dict]:
+    """分页拉取某个 KB 下全部行的指定列（必须包含 `id`）。
+
+    分页用 `id > 上一页最大 id` 的游标方式，不受 PostgREST `max-rows` 限制，
+    也不会像 offset 分页那样越翻越慢。
+    """
+    rows: list[dict] = []
+    last_id = 0
+    client = shared_client(supabase_url, supabase_key)
+    while True:
+        page, _ = client.request_json(
+            "GET",
+            "/rest/v1/travel_knowledge",
+            params={
+                "select": columns,
+                "kb_slug": f"eq.{kb_slug}",
+                "id": f"gt.{last_id}",
+                "order": "id.asc",
+                "limit": "10000",
+            },
+        )
+        if not page:
+            break
+        rows.extend(page)
+        last_id = max(int(row["id"]) for row in page)
+    return rows
+
+
+def fetch_existing_hashes(supabase_url: str, supabase_key: str, kb_slug: str) -> set[str]:
+    """拉取某个 KB 下已经入库的全部 `content_hash`。
+
+    写入时冲突键是 `(kb_slug, content_hash)`，数据库会忽略重复行；
+    提前拿到这份集合，就能在 embedding 之前把注定被忽略的 chunk 过滤掉。
+    """
+    rows = fetch_kb_rows(supabase_url, supabase_key, kb_slug)
+    return {row["content_hash"] for row in rows if row.get("content_hash")}
+
+
+def file_content_index(file_path: str) -> dict[str, object]:
+    """扫描整个 JSONL，返回 `content_hash -> external_id`；只算 MD5，不跑模型。"""
+    return {
+        md5_text(normalize_text(chunk.get("content"))): chunk.get("id")
+        for chunk, _ in iter_chunks(file_path)
+    }
+
+
+def plan_incremental(
+    kb_rows: list[dict],
+    new_index: dict[str, object],
+    previous_version: str,
+    dataset_version: str,
+) -> dict:
+    """对比库里的行和新 JSONL，算出增量入库要做的事。
+
+    - 内容没变（`content_hash` 已在库里）：不 embed，已有行改标为新版本，向量原样保留
+    - 新增或内容变化：照常 embed 并插入（由 `skip_existing_chunks` 放行）
+    - 旧版本里 `content_hash` 不再出现的行：删除；其中 `external_id` 仍在新文件里的算“变更”
+    """
+    known_hashes = {row["content_hash"] for row in kb_rows}
+    new_ids = set(new_index.values())
+    removed = [
+        row
+        for row in kb_rows
+        if row.get("dataset_version") == previous_version and row["content_hash"] not in new_index
+    ]
+    changed = sum(1 for row in removed if row.get("external_id") in new_ids)
+    return {
+        "carry_ids": [
+            row["id"]
+            for row in kb_rows
+            if row["content_hash"] in new_index and row.get("dataset_version") != dataset_version
+        ],
+        "delete_ids": [row["id"] for row in removed],
+        "to_embed": sum(1 for content_hash in new_index if content_hash not in known_hashes),
+        "changed": changed,
+        "removed": len(removed) - changed,
+    }
+
+
+def apply_incremental(supabase_url: str, supabase_key: str, plan: dict, dataset_version: str) -> None:
+    """新版本的行全部写完后再执行：先把未变化的行改标为新版本，再删掉旧版本中已移除的行。
+
+    两步都按 id 操作、可以重复执行，中途失败后续跑会再补一遍。
+    """
+    client = shared_client(supabase_url, supabase_key)
+    for ids in batched(plan["carry_ids"], INCREMENTAL_ID_BATCH):
+        client.request_json(
+            "PATCH",
+            "/rest/v1/travel_knowledge",
+            params={"id": f"in.({','.join(str(row_id) for row_id in ids)})"},
+            body={"dataset_version": dataset_version},
+            extra_headers={"Prefer": "return=minimal"},
+        )
+    for ids in batched(plan["delete_ids"], INCREMENTAL_ID_BATCH):
+        client.request_json(
+            "DELETE",
+            "/rest/v1/travel_knowledge",
+            params={"id": f"in.({','.join(str(row_id) for row_id in ids)})"},
+            extra_headers={"Prefer": "return=minimal"},
+        )
+    print(
+        f"Incremental: carried forward {len(plan['carry_ids'])} rows, "
+        f"deleted {len(plan['delete_ids'])} stale rows"
+    )
+
+
+def finalize_shards(args: argparse.Namespace, checkpoint_path: Path, dataset_version: str) -> int:
+    """所有分片都 completed 后，执行一次 `--incremental-from` 的改标和删除。
+
+    分片入库时每个分片只看得到自己写完，全局删除旧版本的行必须等所有分片都写完，
+    所以单独作为收尾步骤，在汇总 checkpoint 确认全部完成后才执行；可以重复执行。
+    """
+    if args.incremental_from == dataset_version:
+        print("--incremental-from must differ from the current dataset version", file=sys.stderr)
+        return 1
+    if not args.supabase_url or not args.supabase_key:
+        print("Missing --supabase-url / --supabase-key (or SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY)", file=sys.stderr)
+        return 1
+    if report_shard_status(args, checkpoint_path, build_job_key(args, dataset_version)) != 0:
+        print(
+            "[error] not every shard has completed; incremental carry-forward / delete not applied. "
+            "Finish (or retry) the remaining shards and rerun --finalize-shards.",
+            file=sys.stderr,
+        )
+        return 1
+    kb_rows = fetch_kb_rows(
+        args.supabase_url,
+        args.supabase_key,
+        args.kb,
+        "id,external_id,content_hash,dataset_version",
+    )
+    plan = plan_incremental(kb_rows, file_content_index(args.file), args.incremental_from, dataset_version)
+    apply_incremental(args.supabase_url, args.supabase_key, plan, dataset_version)
+    return 0
+
+
+def skip_existing_chunks(
+    entries: Iterable[tuple[dict, int]],
+    existing_hashes: set[str],
+    counter: dict[str, int],
+) -> Iterator[tuple[dict, int]]:
+    """过滤掉 content_hash 已在库里的 chunk，并把跳过数累加到 `counter["skipped"]`。"""
+    for chunk, offset in entries:
+        if md5_text(normalize_text(chunk.get("content"))) in existing_hashes:
+            counter["skipped"] += 1
+            continue
+        yield chunk, offset
+
+
+def select_chunks(entries: Iterable[tuple[dict, int]], content_hashes: set[str]) -> Iterator[tuple[dict, int]]:
+    """只保留 content_hash 在 `content_hashes` 里的 chunk，用于重试上次被拒绝的行。"""
+    for chunk, offset in entries:
+        if md5_text(normalize_text(chunk.get("content"))) in content_hashes:
+            yield chunk, offset
+
+
+def run_job(args: argparse.Namespace, session: EmbedderSession, telemetry: IngestTelemetry | None) -> dict:
+    """执行一个 (file, kb, dataset_version) 入库任务，返回结果摘要。
 
     整体步骤：
-    1. 解析命令行和环境变量
-    2. 读取 JSONL chunk
-    3. 加载本地 Qwen embedding 模型（只加载一次）
-    4. 分批生成向量
-    5. 分批写入 Supabase
+    1. 读取 checkpoint，定位 JSONL 续跑偏移
+    2. 从 `session` 取常驻的 embedding 模型（整个进程只加载一次）
+    3. 流式读取 chunk，分批生成向量
+    4. 分批写入 Supabase，并记录已处理到的字节偏移
     """
-    args = parse_args()
     dataset_version = args.dataset_version or infer_dataset_version(args.file)
-    checkpoint_path = Path(args.checkpoint_file).resolve()
+    checkpoint_path = shard_checkpoint_path(
+        Path(args.checkpoint_file).resolve(),
+        args.shard_by,
+        args.shard_id,
+        args.num_shards,
+    )
     job_key = build_job_key(args, dataset_version)
+    result = {
+        "file": args.file,
+        "kb": args.kb,
+        "dataset_version": dataset_version,
+        "status": "failed",
+        "processed": 0,
+        "written": 0,
+    }
 
-    if not Path(args.file).exists():
-        print(f"Input file not found: {args.file}", file=sys.stderr)
-        return 1
+    file_error = validate_input_file(args.file)
+    if file_error:
+        print(file_error, file=sys.stderr)
+        return result
 
-    if not args.dry_run:
+    if args.incremental_from == dataset_version:
+        print("--incremental-from must differ from the current dataset version", file=sys.stderr)
+        return result
+
+    # `--sink copy` 直连数据库写入；查已有行和增量的 PATCH / DELETE 仍走 PostgREST。
+    if (not args.dry_run and args.sink == "rest") or args.skip_existing or args.incremental_from:
         if not args.supabase_url:
             print("Missing --supabase-url or SUPABASE_URL", file=sys.stderr)
-            return 1
+            return result
         if not args.supabase_key:
             print("Missing --supabase-key or SUPABASE_SERVICE_ROLE_KEY", file=sys.stderr)
-            return 1
+            return result
 
     print("=== Local Qwen -> Supabase ingest ===")
     print(f"Input file: {args.file}")
@@ -394,93 +1989,722 @@ def main() -> int:
     print(f"Dataset version: {dataset_version}")
     print(f"Model path: {args.model_path}")
     print(f"Embedding dim: {args.dim}")
+    if args.extra_dims:
+        print(f"Extra dims: {', '.join(EXTRA_DIM_COLUMN.format(dim=dim) for dim in args.extra_dims)}")
     print(f"Device: {args.device}")
+    if args.embed_backend != "torch":
+        print(f"Embedding backend: {args.embed_backend}")
+    if args.workers > 1:
+        print(f"Embedding workers: {args.workers}")
+    if args.max_batch_tokens:
+        print(f"Max batch tokens: {args.max_batch_tokens}")
+    if args.length_bucket_window:
+        print(f"Length bucket window: {args.length_bucket_window}")
+    if args.num_shards > 1:
+        print(f"Shard: {args.shard_id}/{args.num_shards} (by {args.shard_by})")
+    if args.export_dir:
+        print(f"Export: {args.export_dir} ({args.export_dtype})")
+    if args.sink != "rest" and not args.dry_run:
+        print(f"Sink: {args.sink}")
     print(f"Dry run: {'yes' if args.dry_run else 'no'}")
     if not args.dry_run:
         print(f"Checkpoint file: {checkpoint_path}")
 
-    chunks = load_chunks(args.file)
-    print(f"Loaded chunks: {len(chunks)}")
-    if not chunks:
-        return 0
-
-    checkpoint_store = {"jobs": {}}
-    checkpoint_state = {
-        "status": "new",
-        "last_success_batch": 0,
-        "last_success_row": 0,
-        "written_rows": 0,
-    }
+    journal = None
+    checkpoint_state = new_job_checkpoint()
+    legacy_skip_rows = 0
+    # 非空表示这是一次重试：只重跑上次被数据库拒绝的行，偏移和已处理行数都不再变化。
+    retry_hashes: set[str] = set()
     if not args.dry_run:
-        checkpoint_store = load_checkpoint_file(checkpoint_path)
+        journal = CheckpointJournal(checkpoint_path)
         if args.reset_checkpoint:
-            checkpoint_store.setdefault("jobs", {}).pop(job_key, None)
-            save_checkpoint_file(checkpoint_path, checkpoint_store)
+            journal.remove(job_key)
+            journal.sync()
             print("Checkpoint reset: 已清除当前任务断点，将从头开始。")
-        checkpoint_state = get_job_checkpoint(checkpoint_store, job_key)
+        checkpoint_state = journal.get(job_key)
         if checkpoint_state.get("status") == "completed":
             print(
                 f"Checkpoint hit: 当前任务已完成，已写入 {checkpoint_state.get('written_rows', 0)} 条。"
             )
-            return 0
-        if checkpoint_state.get("last_success_batch", 0) > 0:
+            journal.close()
+            return {
+                **result,
+                "status": "completed",
+                "processed": int(checkpoint_state.get("last_success_row", 0)),
+                "written": int(checkpoint_state.get("written_rows", 0)),
+            }
+        if "next_offset" not in checkpoint_state:
+            # 旧版 checkpoint 只记录了批次号；只能按已处理行数跳过一次，之后就改写成偏移。
+            legacy_skip_rows = int(checkpoint_state.get("last_success_row", 0))
+            checkpoint_state = {
+                "status": checkpoint_state.get("status", "running"),
+                "next_offset": 0,
+                "last_success_row": legacy_skip_rows,
+                "written_rows": int(checkpoint_state.get("written_rows", 0)),
+            }
+            if args.export_dir and legacy_skip_rows:
+                # 旧版 checkpoint 没有字节偏移：导出产物无法对齐，已跳过的行也不会再导出，产物会悄悄缺行。
+                print(
+                    "[error] --export-dir cannot resume from a legacy checkpoint without byte offsets; "
+                    "rerun with --reset-checkpoint to export every row, or drop --export-dir for this run.",
+                    file=sys.stderr,
+                )
+                journal.close()
+                return result
+        check_resume_offset(args.file, int(checkpoint_state["next_offset"]))
+        if checkpoint_state.get("status") == "incomplete":
+            retry_hashes = set(checkpoint_state.get("rejected_hashes", []))
+            print(
+                f"Checkpoint hit: 上次入库已跑完，但有 {len(retry_hashes)} 条 chunk 被数据库拒绝，"
+                f"本次只重试这些行（之前已成功写入 {checkpoint_state.get('written_rows', 0)} 条）。"
+            )
+        elif checkpoint_state["next_offset"] > 0 or legacy_skip_rows > 0:
             print(
                 "Checkpoint hit: "
-                f"将从 batch {checkpoint_state['last_success_batch'] + 1} 继续，"
+                f"将从第 {checkpoint_state.get('last_success_row', 0) + 1} 条 chunk 继续"
+                f"（byte offset {checkpoint_state['next_offset']}），"
                 f"之前已成功写入 {checkpoint_state.get('written_rows', 0)} 条。"
             )
 
-    # 模型加载是启动阶段最重的一步，所以这里只加载一次，后面循环复用。
-    embedder = LocalQwenEmbedder(args.model_path, args.dim, args.device)
-
-    written = int(checkpoint_state.get("written_rows", 0)) if not args.dry_run else 0
-    for batch_index, batch in enumerate(batched(chunks, args.batch_size), start=1):
-        if not args.dry_run and batch_index <= checkpoint_state.get("last_success_batch", 0):
-            continue
+    start_offset = int(checkpoint_state.get("next_offset", 0))
+    keep_line = line_shard_predicate(args.shard_id, args.num_shards) if args.shard_by == "line" else None
+    if retry_hashes:
+        # 被拒绝的行散落在整个文件里，从头扫一遍按 content_hash 挑出来；这些 hash 本来就属于当前分片。
+        chunk_stream = select_chunks(iter_chunks(args.file, 0, keep_line), retry_hashes)
+    else:
+        chunk_stream = iter_chunks(args.file, start_offset, keep_line)
+        for _ in range(legacy_skip_rows):
+            if next(chunk_stream, None) is None:
+                break
+        if args.num_shards > 1 and args.shard_by == "hash":
+            chunk_stream = shard_chunks(chunk_stream, args.shard_id, args.num_shards)
+
+    if args.supabase_url and args.supabase_key:
+        # 先按命令行参数建好连接池，之后的读写都复用这些 keep-alive 连接。
+        shared_client(
+            args.supabase_url,
+            args.supabase_key,
+            pool_size=args.upload_workers,
+            gzip_requests=args.http_gzip_requests,
+        )
 
-        # 只对 `content` 做语义向量化。
-        # 其他字段主要用于筛选、展示和回溯来源，不应该混进语义向量。
-        if args.dry_run:
-            texts = [normalize_text(item.get("content")) for item in batch]
-            embeddings = embedder.encode(texts)
-            rows = build_rows(batch, embeddings, args.kb, dataset_version)
-            print(f"[dry-run] batch {batch_index}: encoded {len(rows)} rows")
-            continue
+    if not args.dry_run:
+        width_error = check_vector_widths(args)
+        if width_error:
+            print(f"[error] {width_error}", file=sys.stderr)
+            journal.close()
+            return result
+
+    skip_counter = {"skipped": 0}
+    incremental_plan = None
+    if args.incremental_from:
+        kb_rows = fetch_kb_rows(
+            args.supabase_url,
+            args.supabase_key,
+            args.kb,
+            "id,external_id,content_hash,dataset_version",
+        )
+        incremental_plan = plan_incremental(
+            kb_rows,
+            file_content_index(args.file),
+            args.incremental_from,
+            dataset_version,
+        )
+        print(
+            f"Incremental from {args.incremental_from}: "
+            f"{incremental_plan['to_embed']} new or changed chunks to embed, "
+            f"{len(incremental_plan['carry_ids'])} unchanged rows to carry forward, "
+            f"{incremental_plan['changed']} changed and {incremental_plan['removed']} removed rows to delete"
+        )
+        if args.num_shards > 1:
+            # 改标和删除是针对整个文件的全局操作，任何一个分片写完时其他分片可能还在写，
+            # 所以分片入库时都不做，等全部完成后由 `--finalize-shards` 执行一次。
+            print("Incremental carry-forward / delete is left to --finalize-shards once every shard completes.")
+        chunk_stream = skip_existing_chunks(
+            chunk_stream,
+            {row["content_hash"] for row in kb_rows},
+            skip_counter,
+        )
+    elif args.skip_existing:
+        existing_hashes = fetch_existing_hashes(args.supabase_url, args.supabase_key, args.kb)
+        print(f"Existing content hashes in kb={args.kb}: {len(existing_hashes)}")
+        chunk_stream = skip_existing_chunks(chunk_stream, existing_hashes, skip_counter)
+
+    # 先探一条数据：空文件或已读到末尾时，没必要去加载模型。
+    first = next(chunk_stream, None)
+    if first is None:
+        if skip_counter["skipped"]:
+            print(f"Skipped existing rows: {skip_counter['skipped']}")
+        print("No remaining chunks to ingest.")
+        status = "dry-run"
+        if not args.dry_run:
+            # 重试时文件里已经找不到这些行（文件被改过），没有可重试的了。
+            rejected = [] if retry_hashes else checkpoint_state.get("rejected_hashes", [])
+            if incremental_plan is not None and args.num_shards == 1 and not rejected:
+                apply_incremental(args.supabase_url, args.supabase_key, incremental_plan, dataset_version)
+            checkpoint_state = finish_job_checkpoint(checkpoint_state, rejected)
+            status = checkpoint_state["status"]
+            journal.set(job_key, checkpoint_state)
+            journal.close()
+        return {
+            **result,
+            "status": status,
+            "processed": int(checkpoint_state.get("last_success_row", 0)),
+            "written": int(checkpoint_state.get("written_rows", 0)),
+        }
+    chunk_stream = itertools.chain([first], chunk_stream)
+
+    verified = None
+    if args.verify_backend and args.embed_backend != "torch" and not session.loaded:
+        sample = list(itertools.islice(chunk_stream, args.verify_backend))
+        chunk_stream = itertools.chain(sample, chunk_stream)
+        verified = verify_backend(args, sample)
+        if verified is None:
+            if journal is not None:
+                journal.close()
+            return result
+        if args.workers > 1:
+            # 多进程模式由各个 worker 自己加载模型，主进程这份用不上。
+            verified = None
+
+    embedder = session.get(verified)
+    del verified
+
+    exporter = None
+    if args.export_dir and retry_hashes:
+        # 被拒绝的行在上次运行时已经导出过了。
+        print("Export: skipped while retrying rejected rows")
+    elif args.export_dir:
+        # 续跑时产物按 checkpoint 偏移截断，和 Supabase 里已提交的行保持一致。
+        export_dir = args.export_dir
+        if args.num_shards > 1:
+            export_dir = str(Path(export_dir) / f"shard-{args.shard_by}-{args.shard_id}-of-{args.num_shards}")
+        exporter = EmbeddingArtifactWriter(
+            export_dir,
+            args.dim,
+            args.export_dtype,
+            start_offset if not args.dry_run else 0,
+            {
+                "model_path": args.model_path,
+                "embed_backend": args.embed_backend,
+                "kb_slug": args.kb,
+                "dataset_version": dataset_version,
+                "file": args.file,
+            },
+            committed_rows=int(checkpoint_state.get("last_success_row", 0)) if not args.dry_run else 0,
+        )
 
-        try:
-            texts = [normalize_text(item.get("content")) for item in batch]
-            embeddings = embedder.encode(texts)
-            rows = build_rows(batch, embeddings, args.kb, dataset_version)
-            upsert_rows(args.supabase_url, args.supabase_key, rows)
-            written += len(rows)
-            checkpoint_state = {
-                "status": "running",
-                "last_success_batch": batch_index,
-                "last_success_row": batch_index * args.batch_size,
-                "written_rows": written,
-            }
-            set_job_checkpoint(checkpoint_store, job_key, checkpoint_state)
-            save_checkpoint_file(checkpoint_path, checkpoint_store)
-            print(f"batch {batch_index}: wrote {len(rows)} rows")
-            time.sleep(0.1)
-        except Exception as exc:
-            batch_ids = [item.get("id") for item in batch]
-            print(f"batch {batch_index}: failed for ids={batch_ids}", file=sys.stderr)
-            raise exc
+    processed = int(checkpoint_state.get("last_success_row", 0)) if not args.dry_run else 0
+    written = int(checkpoint_state.get("written_rows", 0)) if not args.dry_run else 0
 
-    if not args.dry_run:
+    retry_rejected: list[str] = []
+
+    def commit_batch(end_offset: int, row_count: int, written_count: int, rejected: list[str]) -> None:
+        nonlocal processed, written, checkpoint_state
+        written += written_count
+        if retry_hashes:
+            # 重试不推进偏移，也不逐批落盘：中途失败时下次仍重试整份清单，写入按 content_hash 幂等。
+            retry_rejected.extend(rejected)
+            return
+        started = time.perf_counter()
+        if exporter is not None:
+            # 产物先落盘再推进 checkpoint，续跑时按偏移截掉的只会是多写的尾部，不会缺行。
+            exporter.flush()
+        processed += row_count
+        rejected_hashes = checkpoint_state.get("rejected_hashes", []) + rejected
         checkpoint_state = {
-            "status": "completed",
-            "last_success_batch": (len(chunks) + args.batch_size - 1) // args.batch_size,
-            "last_success_row": len(chunks),
+            "status": "running",
+            "next_offset": end_offset,
+            "last_success_row": processed,
             "written_rows": written,
+            **({"rejected_hashes": rejected_hashes} if rejected_hashes else {}),
         }
-        set_job_checkpoint(checkpoint_store, job_key, checkpoint_state)
-        save_checkpoint_file(checkpoint_path, checkpoint_store)
+        journal.set(job_key, checkpoint_state)
+        if telemetry is not None:
+            telemetry.record("checkpoint", rows=row_count, checkpoint_seconds=time.perf_counter() - started)
+
+    def prepare_batches() -> Iterator[tuple[list[dict], list[dict], int]]:
+        """拼出每个 embedding 批次的行，顺带记录主线程等待向量和 `build_rows` 的耗时。"""
+        embedded = embed_batches(
+            embedder,
+            chunk_stream,
+            args.batch_size,
+            args.length_bucket_window,
+            args.max_batch_tokens,
+        )
+        waited = time.perf_counter()
+        for batch_index, (entries, embeddings) in enumerate(embedded, start=1):
+            ready = time.perf_counter()
+            batch = [chunk for chunk, _ in entries]
+            extra_embeddings = None
+            if args.extra_dims:
+                views = matryoshka_views(embeddings, [args.dim, *args.extra_dims])
+                embeddings = views[args.dim]
+                extra_embeddings = {EXTRA_DIM_COLUMN.format(dim=dim): views[dim] for dim in args.extra_dims}
+            rows = build_rows(batch, embeddings, args.kb, dataset_version, extra_embeddings)
+            if telemetry is not None:
+                stats = getattr(embedder, "stats", {})
+                telemetry.record_embed(
+                    stats,
+                    batch=batch_index,
+                    rows=len(rows),
+                    embed_wait_seconds=ready - waited,
+                    build_rows_seconds=time.perf_counter() - ready,
+                    worker_peak_rss_bytes=stats.get("worker_peak_rss_bytes", 0),
+                )
+            if exporter is not None:
+                exporter.append(rows, entries[-1][1])
+            yield batch, rows, entries[-1][1]
+            waited = time.perf_counter()
+
+    if args.dry_run:
+        try:
+            for batch_index, (_, rows, _) in enumerate(prepare_batches(), start=1):
+                processed += len(rows)
+                print(f"[dry-run] batch {batch_index}: encoded {len(rows)} rows")
+        except BaseException:
+            if exporter is not None:
+                exporter.close()
+            raise
+    else:
+        dead_letter = DeadLetterWriter(args.dead_letter_file)
+        if args.sink == "copy":
+            sink = PostgresCopySink(args.database_url, args.vector_precision)
+        else:
+            sink = RestUpsertSink(args.supabase_url, args.supabase_key, args.vector_precision)
+        pipeline = UpsertPipeline(
+            sink,
+            args.upload_workers,
+            args.max_pending_batches,
+            commit_batch,
+            AdaptiveUpsertSizer(
+                args.upsert_rows,
+                args.upsert_max_rows,
+                args.upsert_max_bytes,
+                args.upsert_target_seconds,
+            ),
+            dead_letter,
+            args.upsert_retries,
+            telemetry,
+            # 重试轮次里全是上次被拒的行，整批再被拒是正常结果，不算配置错误。
+            circuit_breaker=not retry_hashes,
+        )
+        try:
+            with pipeline:
+                for batch, rows, end_offset in prepare_batches():
+                    pipeline.add(rows, end_offset, [item.get("id") for item in batch])
+        except BaseException:
+            # 失败时也把已提交的进度合并进快照，同一进程里的下一个任务会重新打开 checkpoint。
+            journal.close()
+            if exporter is not None:
+                # 回填行数、关掉文件，缓冲里的行不留在半截状态；多写的尾部续跑时按偏移截掉。
+                exporter.close()
+            raise
+        finally:
+            sink.close()
+
+        rejected = retry_rejected if retry_hashes else checkpoint_state.get("rejected_hashes", [])
+        if incremental_plan is not None and args.num_shards == 1:
+            if rejected:
+                # 被拒绝的行还没写进新版本，这时删除旧版本的行会丢数据；等重试成功后再执行。
+                print("Incremental carry-forward / delete deferred until the rejected rows are written.")
+            else:
+                apply_incremental(args.supabase_url, args.supabase_key, incremental_plan, dataset_version)
+        checkpoint_state = finish_job_checkpoint({**checkpoint_state, "written_rows": written}, rejected)
+        journal.set(job_key, checkpoint_state)
+        journal.close()
+        if dead_letter.count:
+            print(f"Rejected rows: {dead_letter.count}, see {dead_letter.path}")
+        if rejected:
+            print(
+                f"Checkpoint marked incomplete with {len(rejected)} rejected rows; "
+                "fix the data or table and rerun the same command to retry only those rows."
+            )
+
+    if exporter is not None:
+        exporter.close()
+        print(f"Exported {exporter.rows} vectors to {exporter.dir}")
+    if args.skip_existing or incremental_plan is not None:
+        print(f"Skipped existing rows: {skip_counter['skipped']}")
+    print(f"Done. Processed rows: {processed}, written rows: {written}")
+    return {
+        **result,
+        "status": "dry-run" if args.dry_run else checkpoint_state["status"],
+        "processed": processed,
+        "written": written,
+        "rejected": 0 if args.dry_run else dead_letter.count,
+    }
+
+
+class LatencyRecorder:
+    """包一层 embedder，记录每次前向调用（一个子批）的耗时，用于 benchmark 统计延迟分位数。"""
+
+    def __init__(self, embedder) -> None:
+        self.embedder = embedder
+        self.latencies: list[float] = []
+
+    def encode_async(self, texts: list[str]) -> Future:
+        started = time.perf_counter()
+        future = self.embedder.encode_async(texts)
+        self.latencies.append(time.perf_counter() - started)
+        return future
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        return self.embedder.token_lengths(texts)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """最近秩法分位数；`values` 需已排序。"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def benchmark_config(
+    embedder: LocalQwenEmbedder,
+    entries: list[tuple[dict, int]],
+    batch_size: int,
+    bucket_window: int,
+    max_batch_tokens: int = 0,
+) -> dict:
+    """用一组参数把样本完整跑一遍，返回吞吐、延迟和 padding 统计。"""
+    if embedder.device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    before = dict(embedder.stats)
+    recorder = LatencyRecorder(embedder)
+    started = time.perf_counter()
+    embedded = embed_batches(recorder, entries, batch_size, bucket_window, max_batch_tokens)
+    rows = sum(len(batch) for batch, _ in embedded)
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    real_tokens = embedder.stats["real_tokens"] - before["real_tokens"]
+    padded_tokens = embedder.stats["padded_tokens"] - before["padded_tokens"]
+    latencies = sorted(recorder.latencies)
+    result = {
+        "batch_size": batch_size,
+        "dim": embedder.dim,
+        "threads": torch.get_num_threads(),
+        "bucket_window": bucket_window,
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_second": round(rows / elapsed, 3),
+        "tokens_per_second": round(real_tokens / elapsed, 1),
+        "padding_ratio": round(padded_tokens / real_tokens, 4) if real_tokens else None,
+        "p50_batch_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_batch_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        # ru_maxrss 只增不减，这里是截至该组合结束时的进程峰值。
+        "peak_rss_mb": round(peak_rss_bytes() / 1024 / 1024, 1),
+    }
+    if embedder.device == "cuda":
+        result["peak_cuda_mb"] = round(torch.cuda.max_memory_allocated() / 1024 / 1024, 1)
+    return result
+
+
+def recommend_settings(results: list[dict], cpu_count: int, dim: int) -> dict:
+    """在 `dim` 维的结果里挑出吞吐最高的组合；吞吐相差 3% 以内时选 p95 延迟更低的。
+
+    输出维度影响检索效果，不只是速度，所以只在当前 `--dim` 下推荐；其他维度仅供对照。
+
+    在 CPU 上如果最优线程数明显少于核数，再按“每进程吞吐 x 进程数”估算多进程的总吞吐，
+    推荐对应的 `--workers` / `--threads-per-worker`（需要内存装得下多份模型）。
+    """
+    results = [result for result in results if result["dim"] == dim] or results
+    best_rate = max(result["rows_per_second"] for result in results)
+    candidates = [result for result in results if result["rows_per_second"] >= best_rate * 0.97]
+    best = min(candidates, key=lambda result: result["p95_batch_ms"])
+    flags = [f"--batch-size {best['batch_size']}"]
+    if best["bucket_window"]:
+        flags.append(f"--length-bucket-window {best['bucket_window']}")
+    recommendation = {"config": best, "flags": flags}
+
+    projections = []
+    for result in results:
+        if result["threads"] >= cpu_count:
+            continue
+        workers = cpu_count // result["threads"]
+        projections.append((result["rows_per_second"] * workers, workers, result))
+    if projections:
+        projected_rate, workers, result = max(projections, key=lambda item: item[0])
+        if workers > 1 and projected_rate > best["rows_per_second"] * 1.2:
+            recommendation["multi_process"] = {
+                "flags": [
+                    f"--workers {workers}",
+                    f"--threads-per-worker {result['threads']}",
+                    f"--batch-size {result['batch_size']}",
+                ]
+                + ([f"--length-bucket-window {result['bucket_window']}"] if result["bucket_window"] else []),
+                "projected_rows_per_second": round(projected_rate, 1),
+            }
+    return recommendation
 
-    print(f"Done. Processed rows: {len(chunks)}, written rows: {written}")
+
+def run_benchmark(args: argparse.Namespace) -> int:
+    """`--benchmark` 入口：只加载一次模型，依次测各参数组合，打印表格并写 JSON 报告。"""
+    entries = list(itertools.islice(iter_chunks(args.file), args.benchmark_sample))
+    if not entries:
+        print(f"No chunks found in {args.file}", file=sys.stderr)
+        return 1
+
+    print("=== Local Qwen embedding benchmark ===")
+    print(f"Input file: {args.file} ({len(entries)} sample chunks)")
+    print(f"Model path: {args.model_path}")
+    print(f"Backend: {args.embed_backend}, device: {args.device}")
+    # token 预算由 `embed_batches` 装批时使用，模型本身不再拆分。
+    embedder = LocalQwenEmbedder(
+        args.model_path,
+        max(args.benchmark_dims),
+        args.device,
+        backend=args.embed_backend,
+        onnx_model=args.onnx_model,
+    )
+    default_threads = torch.get_num_threads()
+    thread_options = list(dict.fromkeys(threads or default_threads for threads in args.benchmark_threads))
+    # 预热一次：首个前向要分配内存、初始化 kernel，不计入结果。
+    embed_entries(embedder, entries[: max(args.benchmark_batch_sizes)], args.max_batch_tokens)
+
+    results = []
+    header = (
+        f"{'batch':>5} {'dim':>5} {'thr':>4} {'bucket':>6} {'rows/s':>9} {'tokens/s':>10} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'pad':>6} {'rss MB':>8}"
+    )
+    print(header)
+    for threads in thread_options:
+        torch.set_num_threads(threads)
+        for dim in args.benchmark_dims:
+            # Matryoshka 截断只发生在池化之后，换维度不需要重新加载模型。
+            embedder.dim = dim
+            for bucket_window in args.benchmark_bucket_windows:
+                for batch_size in args.benchmark_batch_sizes:
+                    result = benchmark_config(embedder, entries, batch_size, bucket_window, args.max_batch_tokens)
+                    results.append(result)
+                    padding = f"{result['padding_ratio']:.2f}" if result["padding_ratio"] else "-"
+                    print(
+                        f"{batch_size:>5} {dim:>5} {result['threads']:>4} {bucket_window:>6} "
+                        f"{result['rows_per_second']:>9.1f} {result['tokens_per_second']:>10.0f} "
+                        f"{result['p50_batch_ms']:>8.1f} {result['p95_batch_ms']:>8.1f} "
+                        f"{padding:>6} {result['peak_rss_mb']:>8.0f}"
+                    )
+    torch.set_num_threads(default_threads)
+
+    if hasattr(os, "sched_getaffinity"):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+    recommendation = recommend_settings(results, cpu_count, args.dim)
+    best = recommendation["config"]
+    print(
+        f"\nRecommended: {' '.join(recommendation['flags'])} "
+        f"({best['rows_per_second']:.1f} rows/s, p95 {best['p95_batch_ms']:.0f} ms, {best['threads']} threads)"
+    )
+    if "multi_process" in recommendation:
+        multi = recommendation["multi_process"]
+        print(
+            f"CPU alternative: {' '.join(multi['flags'])} "
+            f"(projected ~{multi['projected_rows_per_second']:.0f} rows/s if memory allows one model per worker)"
+        )
+
+    report = {
+        "file": args.file,
+        "sample_rows": len(entries),
+        "model_path": args.model_path,
+        "embed_backend": args.embed_backend,
+        "device": embedder.device,
+        "cpu_count": cpu_count,
+        "max_batch_tokens": args.max_batch_tokens,
+        "results": results,
+        "recommendation": recommendation,
+    }
+    report_path = Path(args.benchmark_report)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Report written to {report_path}")
     return 0
 
 
+class EmbedderSession:
+    """按需加载并在多个任务之间共享 embedding 模型。
+
+    模型加载是启动阶段最重的一步：第一个真正需要 embedding 的任务才加载，
+    之后的任务直接复用；全部任务都已完成或无需 embedding 时，整个进程都不会加载模型。
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.embedder = None
+        self.base_embedder = None
+        self.cache: EmbeddingCache | None = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.embedder is not None
+
+    def get(self, embedder: LocalQwenEmbedder | None = None):
+        """返回常驻的 embedder；首次调用时传入 `embedder` 则直接采用这份已加载的模型，不再重新加载。"""
+        if self.embedder is not None:
+            return self.embedder
+        args = self.args
+        # `--max-batch-tokens` 由 `embed_batches` 装批时使用；模型再按预算拆一遍只会把每条文本多分词两次。
+        if embedder is None and args.workers > 1:
+            embedder = ParallelEmbedder(
+                args.model_path,
+                embedding_output_dim(args),
+                args.workers,
+                args.threads_per_worker,
+                backend=args.embed_backend,
+                onnx_model=args.onnx_model,
+            )
+        elif embedder is None:
+            embedder = LocalQwenEmbedder(
+                args.model_path,
+                embedding_output_dim(args),
+                args.device,
+                backend=args.embed_backend,
+                onnx_model=args.onnx_model,
+            )
+        self.base_embedder = embedder
+        if args.embedding_cache:
+            # 换数据版本或 KB 时大部分 content_hash 不变，命中缓存的 chunk 不再过模型。
+            self.cache = EmbeddingCache(
+                args.embedding_cache,
+                embedding_cache_namespace(
+                    args.model_path,
+                    embedding_output_dim(args),
+                    args.embed_backend,
+                    args.onnx_model,
+                ),
+                args.embedding_cache_max_mb * 1024 * 1024,
+            )
+            embedder = CachedEmbedder(embedder, self.cache)
+        self.embedder = embedder
+        return embedder
+
+    def close(self) -> None:
+        if self.cache is not None:
+            print(f"Embedding cache: {self.embedder.hits} hits, {self.embedder.misses} misses")
+            self.cache.close()
+        if isinstance(self.base_embedder, ParallelEmbedder):
+            self.base_embedder.close()
+
+
+# 有行被拒绝（`incomplete`）或失败的任务都让进程以非 0 退出。
+JOB_SUCCESS_STATUSES = ("completed", "dry-run")
+
+# 清单里每个任务可以覆盖的参数，其余参数（模型、设备、上传配置等）对所有任务共用。
+MANIFEST_JOB_KEYS = {
+    "file",
+    "kb",
+    "dataset_version",
+    "incremental_from",
+    "skip_existing",
+    "reset_checkpoint",
+    "export_dir",
+}
+
+
+def load_manifest(manifest_path: str) -> list[dict]:
+    """读取任务清单：顶层可以是任务列表，也可以是 `{"jobs": [...]}`。
+
+    YAML 需要安装 PyYAML；相对路径按清单文件所在目录解析。
+    """
+    path = Path(manifest_path)
+    text = path.read_text(encoding="utf-8")
+    if path.suffix.lower() in {".yaml", ".yml"}:
+        try:
+            import yaml
+        except ImportError as exc:
+            raise RuntimeError("YAML manifests require PyYAML: pip install pyyaml (or use a JSON manifest)") from exc
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    jobs = data.get("jobs") if isinstance(data, dict) else data
+    if not isinstance(jobs, list) or not jobs:
+        raise ValueError(f"Manifest {manifest_path} has no jobs")
+    for index, job in enumerate(jobs, start=1):
+        if not isinstance(job, dict) or not job.get("file"):
+            raise ValueError(f"Manifest job {index} must be an object with a 'file'")
+        unknown = set(job) - MANIFEST_JOB_KEYS
+        if unknown:
+            raise ValueError(f"Manifest job {index} has unsupported keys: {', '.join(sorted(unknown))}")
+        for key in ("file", "export_dir"):
+            if job.get(key):
+                job[key] = resolve_project_path(job[key], base_dir=path.resolve().parent)
+    return jobs
+
+
+def manifest_job_args(args: argparse.Namespace, job: dict) -> argparse.Namespace:
+    """用清单里的字段覆盖命令行参数，得到单个任务的参数。"""
+    job_args = argparse.Namespace(**{**vars(args), **job})
+    if not job_args.dataset_version:
+        job_args.dataset_version = infer_dataset_version(job_args.file)
+    if args.export_dir and "export_dir" not in job:
+        # 多个任务共用一个导出目录时，按 KB / 数据版本分子目录，避免互相覆盖。
+        job_args.export_dir = str(Path(args.export_dir) / job_args.kb / job_args.dataset_version)
+    return job_args
+
+
+def main() -> int:
+    """入库入口：单个 `--file`，或 `--manifest` 中的多个任务共用一份常驻模型。"""
+    args = parse_args()
+    if args.benchmark:
+        return run_benchmark(args)
+    if args.shard_status:
+        dataset_version = args.dataset_version or infer_dataset_version(args.file)
+        return report_shard_status(args, Path(args.checkpoint_file).resolve(), build_job_key(args, dataset_version))
+    if args.finalize_shards:
+        dataset_version = args.dataset_version or infer_dataset_version(args.file)
+        return finalize_shards(args, Path(args.checkpoint_file).resolve(), dataset_version)
+
+    session = EmbedderSession(args)
+    telemetry = IngestTelemetry(args.metrics_file) if args.metrics_file else None
+    results: list[dict] = []
+    try:
+        if not args.manifest:
+            results.append(run_job(args, session, telemetry))
+        else:
+            jobs = load_manifest(args.manifest)
+            for index, job in enumerate(jobs, start=1):
+                print(f"\n### Job {index}/{len(jobs)}: {job['file']}")
+                job_args = manifest_job_args(args, job)
+                try:
+                    results.append(run_job(job_args, session, telemetry))
+                except Exception as exc:
+                    # 一个任务失败不影响后面的任务；进度已经记在各自的 checkpoint 里。
+                    print(f"[error] job {index} failed: {exc}", file=sys.stderr)
+                    results.append(
+                        {
+                            "file": job_args.file,
+                            "kb": job_args.kb,
+                            "dataset_version": job_args.dataset_version,
+                            "status": "failed",
+                            "processed": 0,
+                            "written": 0,
+                        }
+                    )
+    finally:
+        session.close()
+
+    if telemetry is not None:
+        summary = telemetry.close()
+        stages = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in summary["stage_seconds"].items())
+        print(
+            f"Throughput: {summary['rows_per_second']:.1f} rows/s, {summary['tokens_per_second']:.0f} tokens/s, "
+            f"peak RSS {summary['peak_rss_bytes'] / 1024 / 1024:.0f} MB; {stages}"
+        )
+        print(f"Metrics written to {telemetry.path}")
+
+    if args.manifest:
+        print("\n=== Manifest summary ===")
+        for index, result in enumerate(results, start=1):
+            print(
+                f"Job {index}: {result['status']} kb={result['kb']} dataset_version={result['dataset_version']} "
+                f"processed={result['processed']} written={result['written']} file={result['file']}"
+            )
+        print(
+            f"Total: {sum(result['status'] in JOB_SUCCESS_STATUSES for result in results)}/{len(results)} jobs succeeded, "
+            f"processed rows: {sum(result['processed'] for result in results)}, "
+            f"written rows: {sum(result['written'] for result in results)}"
+        )
+    return 0 if all(result["status"] in JOB_SUCCESS_STATUSES for result in results) else 1
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
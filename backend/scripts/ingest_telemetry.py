@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Per-stage throughput telemetry for the local Qwen ingest.
+
+入库慢的时候，需要先分清是模型、网络还是序列化拖了后腿，再决定调 batch size 还是换机器。
+这里把各阶段耗时按事件记下来：
+
+- `embed`：每个 embedding 批次，含 tokenize / forward / pool 耗时（取 embedder 累计值的增量）、
+  真实 token 数与 padding 后 token 数、`build_rows` 耗时、主线程等待向量的时间
+- `upload`：每次 upsert，含 JSON 序列化、HTTP 请求耗时、请求体字节数和重试次数
+- `checkpoint`：每次提交 checkpoint 的耗时
+- `summary`：结束时的总量、rows/s、tokens/s 和各阶段累计耗时
+
+输出格式按文件后缀决定：`.prom` / `.txt` 写 OpenMetrics 文本（累计值，定期原子覆盖，
+可以交给 node_exporter 的 textfile collector），其他后缀逐行写 JSONL。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，峰值内存记为 0。
+    resource = None
+
+OPENMETRICS_SUFFIXES = {".prom", ".txt"}
+# OpenMetrics 文件最多每隔这么久覆盖一次，避免每批都重写。
+OPENMETRICS_INTERVAL_SECONDS = 15.0
+# 这些字段是累计量，`embed` 事件里记录的是与上一批相比的增量。
+EMBED_STAT_KEYS = ("tokenize_seconds", "forward_seconds", "pool_seconds", "real_tokens", "padded_tokens")
+
+
+def new_embed_stats() -> dict[str, float]:
+    """embedder 内部累计的计时与 token 计数。"""
+    return {key: 0 for key in EMBED_STAT_KEYS}
+
+
+def merge_embed_stats(target: dict[str, float], delta: dict[str, float]) -> None:
+    for key in EMBED_STAT_KEYS:
+        target[key] += delta.get(key, 0)
+
+
+def peak_rss_bytes() -> int:
+    """当前进程与已结束子进程中的最大常驻内存（Linux 上 `ru_maxrss` 单位是 KB）。"""
+    if resource is None:
+        return 0
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+class IngestTelemetry:
+    """线程安全的事件记录器；上传线程和主线程都会调用 `record`。"""
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.openmetrics = self.path.suffix.lower() in OPENMETRICS_SUFFIXES
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.started = time.monotonic()
+        self.stage_seconds: dict[str, float] = defaultdict(float)
+        self.counters: dict[str, float] = defaultdict(float)
+        self._last_embed_stats = new_embed_stats()
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        self._handle = None if self.openmetrics else self.path.open("w", encoding="utf-8")
+
+    def record(self, event: str, **fields) -> None:
+        """记录一条事件；`*_seconds` 字段计入对应阶段的累计耗时，其余数值字段计入计数器。"""
+        with self._lock:
+            self.counters[f"{event}_events"] += 1
+            for key, value in fields.items():
+                # 批次编号和内存峰值是标签 / 瞬时值，不做累加。
+                if not isinstance(value, (int, float)) or key in {"batch", "upload"} or key.endswith("peak_rss_bytes"):
+                    continue
+                if key.endswith("_seconds"):
+                    self.stage_seconds[key[: -len("_seconds")]] += value
+                else:
+                    self.counters[f"{event}_{key}"] += value
+            if self._handle is not None:
+                payload = {
+                    "event": event,
+                    "elapsed_seconds": round(time.monotonic() - self.started, 4),
+                    **{key: round(value, 6) if isinstance(value, float) else value for key, value in fields.items()},
+                    "peak_rss_bytes": peak_rss_bytes(),
+                }
+                self._handle.write(json.dumps(payload, ensure_ascii=False))
+                self._handle.write("\n")
+                self._handle.flush()
+            elif time.monotonic() - self._last_flush >= OPENMETRICS_INTERVAL_SECONDS:
+                self._write_openmetrics()
+
+    def record_embed(self, embed_stats: dict[str, float], **fields) -> None:
+        """记录一个 embedding 批次；`embed_stats` 是 embedder 的累计值，这里换算成增量。"""
+        with self._lock:
+            delta = {key: embed_stats.get(key, 0) - self._last_embed_stats[key] for key in EMBED_STAT_KEYS}
+            self._last_embed_stats = {key: embed_stats.get(key, 0) for key in EMBED_STAT_KEYS}
+        self.record("embed", **fields, **delta)
+
+    def summary(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        rows = self.counters.get("embed_rows", 0)
+        tokens = self.counters.get("embed_real_tokens", 0)
+        padded = self.counters.get("embed_padded_tokens", 0)
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "rows": int(rows),
+            "rows_per_second": round(rows / elapsed, 3),
+            "tokens_per_second": round(tokens / elapsed, 3),
+            "padding_ratio": round(padded / tokens, 4) if tokens else None,
+            "uploaded_rows": int(self.counters.get("upload_rows", 0)),
+            "uploaded_bytes": int(self.counters.get("upload_bytes", 0)),
+            "stage_seconds": {name: round(value, 3) for name, value in sorted(self.stage_seconds.items())},
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+
+    def _write_openmetrics(self) -> None:
+        lines = [
+            "# TYPE ingest_stage_seconds counter",
+            "# HELP ingest_stage_seconds Cumulative wall time spent per ingest stage.",
+        ]
+        for name, value in sorted(self.stage_seconds.items()):
+            lines.append(f'ingest_stage_seconds_total{{stage="{name}"}} {value:.6f}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE ingest_{name} counter")
+            lines.append(f"ingest_{name}_total {value:g}")
+        lines.extend(
+            [
+                "# TYPE ingest_elapsed_seconds gauge",
+                f"ingest_elapsed_seconds {time.monotonic() - self.started:.3f}",
+                "# TYPE ingest_peak_rss_bytes gauge",
+                f"ingest_peak_rss_bytes {peak_rss_bytes()}",
+                "# EOF",
+            ]
+        )
+        temp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        temp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(temp_path, self.path)
+        self._last_flush = time.monotonic()
+
+    def close(self) -> dict:
+        """写出汇总并关闭文件，返回汇总内容方便打印。"""
+        summary = self.summary()
+        with self._lock:
+            if self._handle is not None:
+                self._handle.write(json.dumps({"event": "summary", **summary}, ensure_ascii=False))
+                self._handle.write("\n")
+                self._handle.close()
+                self._handle = None
+            else:
+                self._write_openmetrics()
+        return summary
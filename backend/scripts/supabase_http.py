@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Pooled keep-alive HTTP client for Supabase PostgREST, shared by the local scripts.
+
+`urllib.request.urlopen` 每次调用都会新建 TCP/TLS 连接；入库和评测脚本要发成千上万次请求，
+握手开销会占掉大半时间。这里用标准库 `http.client` 维护一个小连接池：
+
+- 连接复用（HTTP/1.1 keep-alive），池大小即最大并发请求数
+- 响应体声明 `Accept-Encoding: gzip`，服务端压缩后自动解压
+- 请求体 gzip 压缩可选开启（需要网关支持 `Content-Encoding: gzip`）
+- 复用的空闲连接被服务端关掉时，自动换新连接重试一次
+
+`base_url` 支持 `http://`，便于对着本地 stub server 调试。
+"""
+
+from __future__ import annotations
+
+import gzip
+import http.client
+import json
+import queue
+import threading
+from urllib import parse
+
+# 小于这个大小的请求体压缩收益不大，直接原样发送。
+GZIP_MIN_BYTES = 1024
+
+
+class SupabaseHTTPError(RuntimeError):
+    """PostgREST 返回非 2xx 状态码时抛出，保留状态码和响应体便于上层判断是否重试。"""
+
+    def __init__(self, status: int, reason: str, body: str) -> None:
+        super().__init__(f"Supabase request failed: HTTP {status} {reason}: {body[:500]}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class SupabaseRestClient:
+    """线程安全的 keep-alive 连接池。"""
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        pool_size: int = 4,
+        timeout: float = 120.0,
+        gzip_requests: bool = False,
+    ) -> None:
+        parsed = parse.urlsplit(base_url)
+        if parsed.scheme not in {"http", "https"} or not parsed.hostname:
+            raise ValueError(f"Unsupported Supabase URL: {base_url}")
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.gzip_requests = gzip_requests
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+        self._idle: queue.LifoQueue[http.client.HTTPConnection] = queue.LifoQueue()
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self) -> tuple[http.client.HTTPConnection, bool]:
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[int, str, dict[str, str], bytes]:
+        """发送一次请求，返回 `(status, reason, headers, 解压后的响应体)`。"""
+        send_headers = {
+            "apikey": self.api_key,
+            "Authorization": f"Bearer {self.api_key}",
+            "Accept-Encoding": "gzip",
+        }
+        if headers:
+            send_headers.update(headers)
+        if body is not None and self.gzip_requests and len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=5)
+            send_headers["Content-Encoding"] = "gzip"
+
+        target = f"{self.base_path}{path}"
+        with self._slots:
+            for attempt in range(2):
+                conn, reused = self._acquire()
+                try:
+                    conn.request(method, target, body=body, headers=send_headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine, http.client.CannotSendRequest):
+                    conn.close()
+                    # 空闲连接可能已被服务端按 keep-alive 超时关闭，换新连接重试一次。
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                except BaseException:
+                    conn.close()
+                    raise
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._idle.put(conn)
+                break
+
+        response_headers = dict(response.getheaders())
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            data = gzip.decompress(data)
+        return response.status, response.reason, response_headers, data
+
+    def request_json(
+        self,
+        method: str,
+        path: str,
+        params: dict[str, str] | None = None,
+        body: object | None = None,
+        extra_headers: dict[str, str] | None = None,
+    ) -> tuple[object, dict[str, str]]:
+        """发送 JSON 请求并解析 JSON 响应；非 2xx 时抛 `SupabaseHTTPError`。
+
+        `body` 传 `bytes` 时视为已经序列化好的 JSON，原样发送。
+        """
+        if params:
+            path = f"{path}?{parse.urlencode(params)}"
+        headers = {"Content-Type": "application/json"}
+        if extra_headers:
+            headers.update(extra_headers)
+        if body is None or isinstance(body, bytes):
+            payload = body
+        else:
+            payload = json.dumps(body).encode("utf-8")
+        status, reason, response_headers, data = self.request(method, path, payload, headers)
+        raw = data.decode("utf-8") if data else ""
+        if status >= 300:
+            raise SupabaseHTTPError(status, reason, raw)
+        return (json.loads(raw) if raw else None), response_headers
+
+
+_CLIENTS: dict[tuple[str, str], SupabaseRestClient] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def shared_client(base_url: str, api_key: str, **options) -> SupabaseRestClient:
+    """按 `(base_url, api_key)` 复用同一个连接池。
+
+    `options` 只在第一次创建时生效；脚本启动时先用命令行参数创建一次，
+    之后各处直接按 URL 取用即可。
+    """
+    key = (base_url.rstrip("/"), api_key)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = SupabaseRestClient(key[0], api_key, **options)
+            _CLIENTS[key] = client
+        return client
+
+
+def request_url_json(
+    method: str,
+    url: str,
+    api_key: str,
+    body: object | None = None,
+    extra_headers: dict[str, str] | None = None,
+) -> tuple[object, dict[str, str]]:
+    """按完整 URL 发送 JSON 请求，连接池按 URL 的 origin 共享。"""
+    parts = parse.urlsplit(url)
+    client = shared_client(f"{parts.scheme}://{parts.netloc}", api_key)
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
+    return client.request_json(method, target, body=body, extra_headers=extra_headers)
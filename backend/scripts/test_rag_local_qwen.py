@@ -15,12 +15,17 @@ from __future__ import annotations
 import argparse
 import datetime as dt
 import json
+import math
 import os
 import re
 import sys
-from collections import Counter, defaultdict
+import time
+from array import array
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from urllib import parse, request
+from typing import Sequence
+from urllib import parse
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -33,17 +38,27 @@ from project_env import get_env, resolve_project_path
 from ingest_local_qwen import (
     DEFAULT_JSONL,
     DEFAULT_MODEL_PATH,
+    EMBED_BACKENDS,
     LocalQwenEmbedder,
+    embedding_cache_namespace,
     infer_dataset_version,
     load_chunks,
     md5_text,
     normalize_text,
+    vector_literal,
 )
+from embedding_artifact import read_npy_header
+from embedding_cache import EmbeddingCache, model_fingerprint
+from supabase_http import request_url_json, shared_client
 
 
 DEFAULT_RERANKER_PATH = resolve_project_path(get_env("QWEN_RERANKER_MODEL_PATH", ""))
 if not DEFAULT_RERANKER_PATH:
     DEFAULT_RERANKER_PATH = resolve_project_path("../../Qwen/Qwen3-Reranker-4B", base_dir=PROJECT_ROOT)
+# training/artifacts/ 整个目录不进 git，缓存文件放在这里不会出现在工作区改动里。
+DEFAULT_CACHE_ROOT = PROJECT_ROOT / "training" / "artifacts" / "rag_cache"
+DEFAULT_QUERY_CACHE = DEFAULT_CACHE_ROOT / "query_embeddings.sqlite"
+DEFAULT_RERANK_CACHE = DEFAULT_CACHE_ROOT / "rerank_scores.sqlite"
 DEFAULT_EVAL_FILE = PROJECT_ROOT / "training" / "data" / "rag_eval_seed.jsonl"
 DEFAULT_EVAL_OUTPUT_ROOT = PROJECT_ROOT / "training" / "artifacts" / "rag_retrieval_eval"
 DEFAULT_QUERIES = [
@@ -71,6 +86,20 @@ TEXT_FIELDS = [
     "content",
 ]
 WORD_RE = re.compile(r"[A-Za-z0-9]+|[\u4e00-\u9fff]+")
+# 本地检索返回的行与 Supabase RPC 的列名保持一致，后面的 RRF / rerank 不需要区分来源。
+LOCAL_ROW_FIELDS = [
+    "doc_id",
+    "external_id",
+    "city",
+    "type",
+    "title",
+    "section_title",
+    "sub_section_title",
+    "poi_name",
+    "content",
+    "tags",
+]
+NPY_TORCH_DTYPES = {"<f4": torch.float32, "<f2": torch.float16, "|i1": torch.int8}
 
 try:
     import jieba  # type: ignore
@@ -109,6 +138,33 @@ def parse_args() -> argparse.Namespace:
         help="Dataset version, default inferred from filename",
     )
     parser.add_argument("--device", default="auto", choices=["auto", "cpu", "cuda"], help="Embedding device")
+    parser.add_argument(
+        "--embed-backend",
+        default=os.getenv("QWEN_EMBEDDING_BACKEND", "torch"),
+        choices=EMBED_BACKENDS,
+        help="Query embedding backend: torch, torch-int8 (CPU dynamic int8) or onnx (onnxruntime)",
+    )
+    parser.add_argument(
+        "--onnx-model",
+        default=os.getenv("QWEN_EMBEDDING_ONNX_PATH", ""),
+        help="ONNX graph for --embed-backend onnx, defaults to <model-path>/onnx/model.onnx",
+    )
+    parser.add_argument(
+        "--backend",
+        default="supabase",
+        choices=["supabase", "local"],
+        help=(
+            "Retrieval backend: supabase RPCs, or local in-process BM25 over --file plus exact dense search "
+            "over --vectors-dir (no network needed with --skip-integrity)"
+        ),
+    )
+    parser.add_argument(
+        "--vectors-dir",
+        default="",
+        help="Embedding export written by ingest_local_qwen.py --export-dir, required for --backend local",
+    )
+    parser.add_argument("--bm25-k1", type=float, default=1.2, help="BM25 k1 for --backend local")
+    parser.add_argument("--bm25-b", type=float, default=0.75, help="BM25 b for --backend local")
     parser.add_argument("--reranker-device", default="auto", choices=["auto", "cpu", "cuda"], help="Reranker device")
     parser.add_argument("--top-k", type=int, default=5, help="Final top-K after rerank")
     parser.add_argument("--dense-top-k", type=int, default=20, help="Dense retrieval candidate size")
@@ -119,7 +175,7 @@ def parse_args() -> argparse.Namespace:
         "--sparse-threshold",
         type=float,
         default=0.05,
-        help="Sparse retrieval threshold used by match_travel_knowledge_sparse",
+        help="Sparse retrieval threshold used by match_travel_knowledge_sparse (not applied to local BM25 scores)",
     )
     parser.add_argument(
         "--threshold",
@@ -135,7 +191,37 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--skip-retrieval", action="store_true", help="Skip retrieval smoke tests")
     parser.add_argument("--sample-limit", type=int, default=20, help="How many sampled JSONL rows to verify")
     parser.add_argument("--page-size", type=int, default=1000, help="Pagination size when reading Supabase rows")
+    parser.add_argument(
+        "--query-cache",
+        default=os.getenv("RAG_QUERY_EMBEDDING_CACHE", str(DEFAULT_QUERY_CACHE)),
+        help=(
+            "SQLite cache of query vectors keyed by (query, model, dim); the embedding model is only loaded "
+            "when some query misses. Empty string disables it"
+        ),
+    )
+    parser.add_argument("--query-cache-max-mb", type=int, default=64, help="Query vector cache size limit in MB")
+    parser.add_argument(
+        "--query-batch-size",
+        type=int,
+        default=16,
+        help="Queries per embedding forward pass; all queries are encoded up front in length-sorted batches",
+    )
+    parser.add_argument(
+        "--retrieval-prefetch",
+        type=int,
+        default=2,
+        help="How many upcoming queries retrieve (sparse and dense RPCs in parallel) while the current one is reranked",
+    )
     parser.add_argument("--reranker-batch-size", type=int, default=4, help="Reranker batch size")
+    parser.add_argument(
+        "--rerank-cache",
+        default=os.getenv("RAG_RERANK_CACHE", str(DEFAULT_RERANK_CACHE)),
+        help=(
+            "SQLite cache of reranker scores keyed by (query, document hash, instruction, model, max length); "
+            "the reranker model is only loaded when some pair misses. Empty string disables it"
+        ),
+    )
+    parser.add_argument("--rerank-cache-max-mb", type=int, default=64, help="Reranker score cache size limit in MB")
     parser.add_argument("--reranker-max-length", type=int, default=4096, help="Reranker max token length")
     parser.add_argument("--preview-chars", type=int, default=600, help="How many content chars to print per hit")
     parser.add_argument(
@@ -161,6 +247,10 @@ def parse_args() -> argparse.Namespace:
         help="Instruction passed into Qwen reranker",
     )
     args = parser.parse_args()
+    if args.retrieval_prefetch < 1:
+        parser.error("--retrieval-prefetch must be >= 1")
+    if args.query_batch_size < 1:
+        parser.error("--query-batch-size must be >= 1")
     if not args.model_path:
         parser.error("Missing embedding model path. Set QWEN_EMBEDDING_MODEL_PATH in .env or pass --model-path.")
     if not args.reranker_path:
@@ -261,20 +351,8 @@ def http_json(
     body: object | None = None,
     extra_headers: dict[str, str] | None = None,
 ) -> tuple[object, dict[str, str]]:
-    headers = {
-        "apikey": api_key,
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    if extra_headers:
-        headers.update(extra_headers)
-
-    payload = None if body is None else json.dumps(body).encode("utf-8")
-    req = request.Request(url, data=payload, method=method, headers=headers)
-    with request.urlopen(req, timeout=120) as resp:
-        raw = resp.read().decode("utf-8") if resp.length != 0 else ""
-        data = json.loads(raw) if raw else None
-        return data, dict(resp.headers.items())
+    # 同一个 Supabase 的请求共享 keep-alive 连接池，避免每次调用都重新握手。
+    return request_url_json(method, url, api_key, body=body, extra_headers=extra_headers)
 
 
 def build_rest_url(supabase_url: str, path: str, params: dict[str, str] | None = None) -> str:
@@ -372,6 +450,19 @@ def fetch_retrieval_docs(args: argparse.Namespace, dataset_version: str) -> list
     return docs
 
 
+def load_local_corpus(file_path: str) -> list[dict]:
+    """本地检索的语料：按 content_hash 去重，与入库时 `(kb_slug, content_hash)` 唯一约束保留的行一致。"""
+    seen: set[str] = set()
+    rows: list[dict] = []
+    for chunk in load_chunks(file_path):
+        content_hash = md5_text(normalize_text(chunk.get("content")))
+        if content_hash in seen:
+            continue
+        seen.add(content_hash)
+        rows.append(chunk)
+    return rows
+
+
 def chunk_samples(chunks: list[dict], sample_limit: int) -> list[dict]:
     if sample_limit <= 0 or not chunks:
         return []
@@ -506,6 +597,132 @@ def prepare_corpus(rows: list[dict]) -> tuple[list[dict], list[str], list[str]]:
     return docs, sorted_cities, sorted_pois
 
 
+def load_vector_export(vectors_dir: str) -> tuple[dict[str, torch.Tensor], dict]:
+    """读取 ingest 导出的向量产物，返回 `{content_hash: 向量}` 和 manifest。
+
+    分片入库时产物在 `shard-*` 子目录里，这里一并读取。int8 产物按 `scales.npy` 还原成 float32。
+    """
+    root = Path(vectors_dir)
+    export_dirs = [root] if (root / "vectors.npy").exists() else sorted(root.glob("shard-*"))
+    export_dirs = [path for path in export_dirs if (path / "vectors.npy").exists()]
+    if not export_dirs:
+        raise FileNotFoundError(f"No vectors.npy found under {vectors_dir}")
+
+    vectors: dict[str, torch.Tensor] = {}
+    manifest: dict = {}
+    for export_dir in export_dirs:
+        manifest = json.loads((export_dir / "manifest.json").read_text(encoding="utf-8"))
+        with (export_dir / "vectors.npy").open("rb") as handle:
+            descr, shape, _ = read_npy_header(handle)
+            matrix = torch.frombuffer(bytearray(handle.read()), dtype=NPY_TORCH_DTYPES[descr]).view(*shape).float()
+        if descr == "|i1":
+            with (export_dir / "scales.npy").open("rb") as handle:
+                read_npy_header(handle)
+                scales = torch.frombuffer(bytearray(handle.read()), dtype=torch.float32)
+            matrix = matrix * scales.unsqueeze(1)
+        with (export_dir / "ids.jsonl").open("r", encoding="utf-8") as handle:
+            for row_index, line in enumerate(handle):
+                if row_index >= matrix.shape[0]:
+                    break
+                content_hash = json.loads(line).get("content_hash")
+                if content_hash and content_hash not in vectors:
+                    vectors[content_hash] = matrix[row_index]
+    return vectors, manifest
+
+
+class LocalHybridIndex:
+    """进程内的检索引擎：BM25 倒排索引 + 精确向量检索，替代 Supabase 的 sparse / dense RPC。
+
+    BM25 直接复用 `prepare_corpus` 算好的 `token_counts` / `doc_len`；
+    向量来自 ingest 的导出产物，按 `content_hash` 与文档对齐，缺向量的文档不参与 dense 检索。
+    """
+
+    def __init__(self, docs: list[dict], vectors: dict[str, torch.Tensor], dim: int, k1: float, b: float) -> None:
+        self.docs = docs
+        self.k1 = k1
+        self.postings: defaultdict[str, list[tuple[int, int]]] = defaultdict(list)
+        for position, doc in enumerate(docs):
+            for term, count in doc["token_counts"].items():
+                self.postings[term].append((position, count))
+        avg_doc_len = (sum(doc["doc_len"] for doc in docs) / len(docs)) if docs else 0.0
+        # BM25 分母里与词无关的部分 `k1 * (1 - b + b * dl / avgdl)`，每篇文档算一次。
+        self.length_norms = [k1 * (1.0 - b + b * doc["doc_len"] / max(avg_doc_len, 1e-9)) for doc in docs]
+        self.idf = {
+            term: math.log(1.0 + (len(docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+        self.matrix = torch.zeros((len(docs), dim), dtype=torch.float32)
+        self.has_vector = torch.zeros(len(docs), dtype=torch.bool)
+        for position, doc in enumerate(docs):
+            vector = vectors.get(md5_text(doc["content"]))
+            if vector is None:
+                continue
+            if vector.shape[0] != dim:
+                raise ValueError(f"Exported vectors have dim {vector.shape[0]}, expected --dim {dim}")
+            self.matrix[position] = vector
+            self.has_vector[position] = True
+        self.missing_vectors = len(docs) - int(self.has_vector.sum())
+        self._scopes: dict[tuple[str | None, str | None], list[int]] = {}
+
+    def scope_positions(self, city: str | None, type_name: str | None) -> list[int]:
+        key = (city, type_name)
+        if key not in self._scopes:
+            self._scopes[key] = [
+                position
+                for position, doc in enumerate(self.docs)
+                if (not city or doc["city"] == city) and (not type_name or doc["type"] == type_name)
+            ]
+        return self._scopes[key]
+
+    def to_row(self, position: int, **scores: float) -> dict:
+        doc = self.docs[position]
+        row = {field: doc[field] for field in LOCAL_ROW_FIELDS}
+        row.update(scores)
+        return row
+
+    def sparse_search(self, query_text: str, city: str | None, type_name: str | None, top_k: int) -> list[dict]:
+        allowed = set(self.scope_positions(city, type_name)) if (city or type_name) else None
+        scores: defaultdict[int, float] = defaultdict(float)
+        for term in dict.fromkeys(tokenize_text(query_text)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, count in self.postings[term]:
+                if allowed is not None and position not in allowed:
+                    continue
+                scores[position] += idf * count * (self.k1 + 1.0) / (count + self.length_norms[position])
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [self.to_row(position, sparse_score=score) for position, score in ranked]
+
+    def dense_search(
+        self,
+        vector,
+        city: str | None,
+        type_name: str | None,
+        top_k: int,
+        threshold: float,
+    ) -> list[dict]:
+        query = torch.tensor(list(vector), dtype=torch.float32)
+        if city or type_name:
+            positions = torch.tensor(self.scope_positions(city, type_name), dtype=torch.long)
+        else:
+            positions = torch.arange(len(self.docs))
+        if positions.numel() == 0:
+            return []
+        positions = positions[self.has_vector[positions]]
+        similarities = self.matrix[positions] @ query
+        keep = similarities >= threshold
+        positions, similarities = positions[keep], similarities[keep]
+        if positions.numel() == 0:
+            return []
+        values, order = torch.topk(similarities, min(top_k, similarities.numel()))
+        return [
+            self.to_row(int(position), similarity=float(value), sparse_score=0.0)
+            for position, value in zip(positions[order].tolist(), values.tolist())
+        ]
+
+
 def infer_query_type(query_text: str) -> str | None:
     query = normalize_text(query_text)
     best_type = None
@@ -604,18 +821,69 @@ def sparse_retrieve(
     return rows
 
 
+class DeferredEmbedder:
+    """首次真正需要算向量时才加载 embedding 模型；查询全部命中缓存时整次运行都不加载。"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.embedder: LocalQwenEmbedder | None = None
+
+    def get(self) -> LocalQwenEmbedder:
+        if self.embedder is None:
+            self.embedder = LocalQwenEmbedder(
+                self.args.model_path,
+                self.args.dim,
+                self.args.device,
+                backend=self.args.embed_backend,
+                onnx_model=self.args.onnx_model,
+            )
+        return self.embedder
+
+    def encode(self, texts: list[str]) -> list[Sequence[float]]:
+        return self.get().encode(texts)
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        return self.get().token_lengths(texts)
+
+
+def encode_queries(
+    embedder: LocalQwenEmbedder | DeferredEmbedder,
+    queries: list[str],
+    batch_size: int,
+    cache: EmbeddingCache | None = None,
+) -> dict[str, Sequence[float]]:
+    """一次性把全部查询向量化：先查缓存，未命中的去重后按 token 长度排序切批，长度相近的查询一起 padding。"""
+    unique_queries = list(dict.fromkeys(queries))
+    vectors: dict[str, Sequence[float]] = {}
+    if cache is not None:
+        cached = cache.get_many(md5_text(query) for query in unique_queries)
+        vectors = {query: cached[md5_text(query)] for query in unique_queries if md5_text(query) in cached}
+    missing = [query for query in unique_queries if query not in vectors]
+    if not missing:
+        return vectors
+
+    lengths = embedder.token_lengths(missing)
+    ordered = [query for _, query in sorted(zip(lengths, missing), key=lambda item: item[0])]
+    fresh: dict[str, Sequence[float]] = {}
+    for start in range(0, len(ordered), batch_size):
+        batch = ordered[start:start + batch_size]
+        fresh.update(zip(batch, embedder.encode(batch)))
+    if cache is not None:
+        cache.put_many({md5_text(query): vector for query, vector in fresh.items()})
+    vectors.update(fresh)
+    return vectors
+
+
 def dense_retrieve(
     args: argparse.Namespace,
     dataset_version: str,
-    embedder: LocalQwenEmbedder,
-    query_text: str,
+    vector: Sequence[float],
     city: str | None,
     type_name: str | None,
 ) -> list[dict]:
-    vector = embedder.encode([query_text])[0]
     url = build_rest_url(args.supabase_url, "/rest/v1/rpc/match_travel_knowledge")
     payload = {
-        "query_embedding": vector,
+        "query_embedding": vector_literal(vector),
         "match_count": args.dense_top_k,
         "filter_kb_slug": args.kb,
         "filter_city": city,
@@ -691,15 +959,31 @@ def rrf_fuse(
 
 
 class LocalQwenReranker:
-    def __init__(self, model_path: str, device: str, max_length: int, batch_size: int, instruction: str) -> None:
+    def __init__(
+        self,
+        model_path: str,
+        device: str,
+        max_length: int,
+        batch_size: int,
+        instruction: str,
+        cache: EmbeddingCache | None = None,
+    ) -> None:
         self.model_path = model_path
         self.device = resolve_device(device)
         self.max_length = max_length
         self.batch_size = batch_size
         self.instruction = instruction
-
+        # 分数缓存：命中的 (query, 文档) 对不再过模型；模型本身也推迟到第一次未命中时才加载。
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self.model = None
+
+    def load_model(self) -> None:
+        if self.model is not None:
+            return
         self.tokenizer = AutoTokenizer.from_pretrained(
-            model_path,
+            self.model_path,
             trust_remote_code=True,
             padding_side="left",
         )
@@ -710,7 +994,7 @@ class LocalQwenReranker:
         if self.device == "cuda":
             model_kwargs["dtype"] = torch.bfloat16
 
-        self.model = AutoModelForCausalLM.from_pretrained(model_path, **model_kwargs).to(self.device).eval()
+        self.model = AutoModelForCausalLM.from_pretrained(self.model_path, **model_kwargs).to(self.device).eval()
         self.token_false_id = self.tokenizer.convert_tokens_to_ids("no")
         self.token_true_id = self.tokenizer.convert_tokens_to_ids("yes")
 
@@ -744,12 +1028,30 @@ class LocalQwenReranker:
         padded = self.tokenizer.pad(inputs, padding=True, return_tensors="pt", max_length=self.max_length)
         return {key: value.to(self.device) for key, value in padded.items()}
 
-    @torch.inference_mode()
     def score(self, query_text: str, rows: list[dict]) -> list[float]:
+        """给每行打分；先按 `(query, 文档内容 MD5)` 查缓存，只有未命中的文档才组批送进模型。"""
+        documents = [build_rerank_document(row) for row in rows]
+        keys = [md5_text(f"{query_text}\n{md5_text(document)}") for document in documents]
+        cached = {key: vector[0] for key, vector in self.cache.get_many(keys).items()} if self.cache is not None else {}
+        # 同一批里重复的文档只算一次。
+        missing = list({key: index for index, key in enumerate(keys) if key not in cached}.values())
+        self.hits += len(rows) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            # 按缓存里的 float32 精度取值，保证首次运行和命中缓存时的分数完全一致。
+            fresh = array("f", self.score_documents(query_text, [documents[index] for index in missing]))
+            fresh_scores = {keys[index]: value for index, value in zip(missing, fresh)}
+            if self.cache is not None:
+                self.cache.put_many({key: [value] for key, value in fresh_scores.items()})
+            cached.update(fresh_scores)
+        return [cached[key] for key in keys]
+
+    @torch.inference_mode()
+    def score_documents(self, query_text: str, documents: list[str]) -> list[float]:
+        self.load_model()
         scores: list[float] = []
-        for start in range(0, len(rows), self.batch_size):
-            batch_rows = rows[start:start + self.batch_size]
-            pairs = [self.format_pair(query_text, build_rerank_document(row)) for row in batch_rows]
+        for start in range(0, len(documents), self.batch_size):
+            pairs = [self.format_pair(query_text, document) for document in documents[start:start + self.batch_size]]
             inputs = self.process_batch(pairs)
             logits = self.model(**inputs).logits[:, -1, :]
             yes_scores = logits[:, self.token_true_id]
@@ -835,34 +1137,45 @@ def summarize_eval(results: list[dict], no_answer_threshold: float) -> dict:
     }
 
 
-def run_query(
+def retrieve_candidates(
     args: argparse.Namespace,
     dataset_version: str,
     docs: list[dict],
     city_names: list[str],
     poi_names: list[str],
-    embedder: LocalQwenEmbedder,
-    reranker: LocalQwenReranker,
+    query_vector: Sequence[float],
     query_text: str,
+    local_index: LocalHybridIndex | None = None,
+    rpc_pool: ThreadPoolExecutor | None = None,
 ) -> dict:
+    """意图解析、sparse / dense 召回和 RRF 融合；给了 `rpc_pool` 时两个 RPC 并发发出。"""
     intent = parse_query_intent(args, query_text, city_names, poi_names)
     scope_name, filter_city, filter_type, scoped_docs = choose_scope(docs, intent)
-    sparse_rows = sparse_retrieve(args, dataset_version, query_text, filter_city, filter_type)
-    dense_rows = dense_retrieve(
-        args,
-        dataset_version,
-        embedder,
-        query_text,
-        filter_city,
-        filter_type,
-    )
+    if local_index is not None:
+        sparse_rows = local_index.sparse_search(query_text, filter_city, filter_type, args.sparse_top_k)
+        dense_rows = local_index.dense_search(
+            query_vector,
+            filter_city,
+            filter_type,
+            args.dense_top_k,
+            args.threshold,
+        )
+    else:
+        sparse_future = None
+        if rpc_pool is not None:
+            sparse_future = rpc_pool.submit(sparse_retrieve, args, dataset_version, query_text, filter_city, filter_type)
+        dense_rows = dense_retrieve(
+            args,
+            dataset_version,
+            query_vector,
+            filter_city,
+            filter_type,
+        )
+        if sparse_future is not None:
+            sparse_rows = sparse_future.result()
+        else:
+            sparse_rows = sparse_retrieve(args, dataset_version, query_text, filter_city, filter_type)
     fused_rows = rrf_fuse(sparse_rows, dense_rows, args.rrf_top_k, args.rrf_k)
-    if fused_rows:
-        rerank_scores = reranker.score(query_text, fused_rows)
-        for row, rerank_score in zip(fused_rows, rerank_scores):
-            row["rerank_score"] = rerank_score
-        fused_rows.sort(key=lambda item: item["rerank_score"], reverse=True)
-    final_rows = fused_rows[: args.top_k]
     return {
         "query": query_text,
         "intent": intent,
@@ -873,10 +1186,65 @@ def run_query(
         "sparse_rows": sparse_rows,
         "dense_rows": dense_rows,
         "fused_rows": fused_rows,
-        "final_rows": final_rows,
     }
 
 
+def rerank_candidates(args: argparse.Namespace, reranker: LocalQwenReranker, result: dict) -> dict:
+    fused_rows = result["fused_rows"]
+    if fused_rows:
+        rerank_scores = reranker.score(result["query"], fused_rows)
+        for row, rerank_score in zip(fused_rows, rerank_scores):
+            row["rerank_score"] = rerank_score
+        fused_rows.sort(key=lambda item: item["rerank_score"], reverse=True)
+    result["final_rows"] = fused_rows[: args.top_k]
+    return result
+
+
+def iter_retrievals(
+    args: argparse.Namespace,
+    dataset_version: str,
+    docs: list[dict],
+    city_names: list[str],
+    poi_names: list[str],
+    query_vectors: dict[str, Sequence[float]],
+    cases: list[dict],
+    local_index: LocalHybridIndex | None,
+):
+    """按顺序产出 `(case, 召回结果)`。
+
+    后面 `--retrieval-prefetch` 个查询的召回在后台线程里提前跑，调用方对当前查询做 rerank 时，
+    下一个查询的 RPC 已经在路上；每个查询的 sparse / dense RPC 也互相并发。
+    """
+    prefetch = args.retrieval_prefetch
+    rpc_pool = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="rpc")
+    prefetch_pool = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="retrieve")
+
+    def submit(case: dict):
+        return prefetch_pool.submit(
+            retrieve_candidates,
+            args,
+            dataset_version,
+            docs,
+            city_names,
+            poi_names,
+            query_vectors[case["query"]],
+            case["query"],
+            local_index,
+            rpc_pool,
+        )
+
+    try:
+        pending = deque(submit(case) for case in cases[:prefetch])
+        for index, case in enumerate(cases):
+            result = pending.popleft().result()
+            if index + prefetch < len(cases):
+                pending.append(submit(cases[index + prefetch]))
+            yield case, result
+    finally:
+        prefetch_pool.shutdown(wait=True, cancel_futures=True)
+        rpc_pool.shutdown(wait=True)
+
+
 def retrieval_check(
     args: argparse.Namespace,
     dataset_version: str,
@@ -886,30 +1254,63 @@ def retrieval_check(
 ) -> bool:
     print("\n=== Retrieval Smoke Test ===")
     docs, city_names, poi_names = prepare_corpus(rows)
-    embedder = LocalQwenEmbedder(args.model_path, args.dim, args.device)
+    local_index = None
+    if args.backend == "local":
+        vectors, manifest = load_vector_export(args.vectors_dir)
+        if manifest.get("model_path") and Path(manifest["model_path"]).resolve() != Path(args.model_path).resolve():
+            print(f"[WARN] Vectors were exported with {manifest['model_path']}, queries use {args.model_path}")
+        local_index = LocalHybridIndex(docs, vectors, args.dim, args.bm25_k1, args.bm25_b)
+        print(
+            f"Local index: {len(docs)} docs, {len(local_index.postings)} terms, "
+            f"{len(docs) - local_index.missing_vectors} with vectors"
+        )
+    embedder = DeferredEmbedder(args)
+    query_cache = None
+    if args.query_cache:
+        query_cache = EmbeddingCache(
+            args.query_cache,
+            embedding_cache_namespace(args.model_path, args.dim, args.embed_backend, args.onnx_model),
+            args.query_cache_max_mb * 1024 * 1024,
+        )
+    rerank_cache = None
+    if args.rerank_cache:
+        # 分数按单元素向量存进同一种 SQLite 缓存；指令、模型、截断长度任一变化都会换命名空间。
+        rerank_cache = EmbeddingCache(
+            args.rerank_cache,
+            "|".join(
+                [
+                    "rerank",
+                    model_fingerprint(args.reranker_path),
+                    f"max_length={args.reranker_max_length}",
+                    f"instruction={md5_text(args.reranker_instruction)}",
+                ]
+            ),
+            args.rerank_cache_max_mb * 1024 * 1024,
+        )
     reranker = LocalQwenReranker(
         args.reranker_path,
         args.reranker_device,
         args.reranker_max_length,
         args.reranker_batch_size,
         args.reranker_instruction,
+        rerank_cache,
     )
 
     cases = eval_cases or [{"id": f"query-{index:03d}", "query": query_text} for index, query_text in enumerate(queries, start=1)]
+    started = time.perf_counter()
+    query_vectors = encode_queries(embedder, [case["query"] for case in cases], args.query_batch_size, query_cache)
+    print(
+        f"Encoded {len(query_vectors)} unique queries in {time.perf_counter() - started:.2f}s "
+        f"(embedding model {'loaded' if embedder.embedder is not None else 'not loaded, all cached'})"
+    )
+    if query_cache is not None:
+        query_cache.close()
     ok = True
     eval_results: list[dict] = []
 
-    for index, case in enumerate(cases, start=1):
-        result = run_query(
-            args,
-            dataset_version,
-            docs,
-            city_names,
-            poi_names,
-            embedder,
-            reranker,
-            case["query"],
-        )
+    retrievals = iter_retrievals(args, dataset_version, docs, city_names, poi_names, query_vectors, cases, local_index)
+    for index, (case, result) in enumerate(retrievals, start=1):
+        result = rerank_candidates(args, reranker, result)
         intent = result["intent"]
         final_rows = result["final_rows"]
 
@@ -989,6 +1390,10 @@ def retrieval_check(
         }
         eval_results.append(eval_item)
 
+    if rerank_cache is not None:
+        print(f"\nRerank cache: {reranker.hits} hits, {reranker.misses} misses")
+        rerank_cache.close()
+
     if eval_cases:
         summary = summarize_eval(eval_results, args.no_answer_threshold)
         print("\n=== Eval Metrics ===")
@@ -1023,10 +1428,17 @@ def validate_args(args: argparse.Namespace, dataset_version: str, queries: list[
             raise ValueError("Integrity check requires --file")
         if not Path(args.file).exists():
             raise FileNotFoundError(f"Input file not found: {args.file}")
-    if not args.supabase_url:
-        raise ValueError("Missing --supabase-url or SUPABASE_URL")
-    if not args.supabase_key:
-        raise ValueError("Missing --supabase-key or SUPABASE_SERVICE_ROLE_KEY / SUPABASE_ANON_KEY")
+    if args.backend == "local" and not args.skip_retrieval:
+        if not args.file:
+            raise ValueError("--backend local requires --file as the retrieval corpus")
+        if not args.vectors_dir or not Path(args.vectors_dir).exists():
+            raise FileNotFoundError(f"--backend local requires an existing --vectors-dir: {args.vectors_dir or '<empty>'}")
+    # 本地检索只有完整性校验需要访问 Supabase。
+    if args.backend == "supabase" or not args.skip_integrity:
+        if not args.supabase_url:
+            raise ValueError("Missing --supabase-url or SUPABASE_URL")
+        if not args.supabase_key:
+            raise ValueError("Missing --supabase-key or SUPABASE_SERVICE_ROLE_KEY / SUPABASE_ANON_KEY")
     if not Path(args.model_path).exists() and not args.skip_retrieval:
         raise FileNotFoundError(f"Model path not found: {args.model_path}")
     if not Path(args.reranker_path).exists() and not args.skip_retrieval:
@@ -1055,13 +1467,30 @@ def main() -> int:
         print(str(exc), file=sys.stderr)
         return 1
 
+    if args.supabase_url and args.supabase_key:
+        # 每个预取中的查询同时有 sparse / dense 两个 RPC 在途，连接池按并发量放大。
+        origin = parse.urlsplit(args.supabase_url)
+        shared_client(
+            f"{origin.scheme}://{origin.netloc}",
+            args.supabase_key,
+            pool_size=max(4, 2 * args.retrieval_prefetch),
+        )
+
     chunks = load_chunks(args.file) if (args.file and not args.skip_integrity) else []
-    retrieval_rows = fetch_retrieval_docs(args, dataset_version) if not args.skip_retrieval else []
+    retrieval_rows: list[dict] = []
+    if not args.skip_retrieval:
+        if args.backend == "local":
+            retrieval_rows = load_local_corpus(args.file)
+        else:
+            retrieval_rows = fetch_retrieval_docs(args, dataset_version)
 
     print("=== RAG Test Runner ===")
     print(f"JSONL file: {args.file}")
     print(f"Knowledge base: {args.kb}")
     print(f"Dataset version: {dataset_version}")
+    print(f"Retrieval backend: {args.backend}")
+    if args.backend == "local":
+        print(f"Vectors dir: {args.vectors_dir}")
     print(f"Supabase URL: {args.supabase_url}")
     print(f"Embedding model path: {args.model_path}")
     print(f"Reranker model path: {args.reranker_path}")
@@ -1075,7 +1504,8 @@ def main() -> int:
     print(f"RRF top-K: {args.rrf_top_k}")
     print(f"Dense threshold: {args.threshold}")
     if retrieval_rows:
-        print(f"Retrieval rows fetched from Supabase: {len(retrieval_rows)}")
+        source = "JSONL" if args.backend == "local" else "Supabase"
+        print(f"Retrieval rows loaded from {source}: {len(retrieval_rows)}")
     if args.eval_file:
         print(f"Eval file: {args.eval_file}")
         print(f"Eval output dir: {args.output_dir}")
@@ -51,6 +51,10 @@ ALTER TABLE public.travel_knowledge ADD COLUMN IF NOT EXISTS license TEXT;
 ALTER TABLE public.travel_knowledge ADD COLUMN IF NOT EXISTS metadata JSONB NOT NULL DEFAULT '{}'::jsonb;
 ALTER TABLE public.travel_knowledge ADD COLUMN IF NOT EXISTS searchable_text TEXT;
 ALTER TABLE public.travel_knowledge ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT now();
+-- Matryoshka 低维向量：与 embedding 同一次前向截断得到（ingest --extra-dims 256,512；只支持这里建了列的维度），
+-- 可用低维列做便宜的粗排索引，再用 1024 维 embedding 精排
+ALTER TABLE public.travel_knowledge ADD COLUMN IF NOT EXISTS embedding_256 VECTOR(256);
+ALTER TABLE public.travel_knowledge ADD COLUMN IF NOT EXISTS embedding_512 VECTOR(512);
 
 CREATE OR REPLACE FUNCTION public.build_travel_knowledge_searchable_text(
   p_city TEXT,
@@ -171,6 +175,10 @@ CREATE INDEX IF NOT EXISTS idx_travel_knowledge_embedding
   ON public.travel_knowledge USING ivfflat (embedding vector_cosine_ops)
   WITH (lists = 100);
 
+CREATE INDEX IF NOT EXISTS idx_travel_knowledge_embedding_256
+  ON public.travel_knowledge USING ivfflat (embedding_256 vector_cosine_ops)
+  WITH (lists = 100);
+
 -- 5. 相似度检索 RPC 函数
 --    后端通过 supabase.rpc('match_travel_knowledge', {...}) 调用
 CREATE OR REPLACE FUNCTION match_travel_knowledge(